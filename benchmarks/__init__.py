@@ -0,0 +1,4 @@
+"""
+Benchmarks against a local fake Bot API server, run them with
+python -m <package>.benchmarks --help
+"""
@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+
+from . import conversion, end_to_end
+
+
+def _print(title: str, results: dict):
+    print(title)
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = "%.3f" % value
+        print("  %-24s %s" % (key, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bot benchmarks against a local fake Bot API server"
+    )
+    parser.add_argument(
+        "suite", nargs="?", default="all", choices=("all", "e2e", "types")
+    )
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="server latency, seconds"
+    )
+    parser.add_argument(
+        "--rate-limit-every",
+        type=int,
+        default=0,
+        help="answer every Nth send with a 429",
+    )
+    parser.add_argument("--no-reply", action="store_true")
+    parser.add_argument("--ordered", action="store_true")
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.suite in ("all", "types"):
+        _print("type conversion", conversion.run(args.number))
+    if args.suite in ("all", "e2e"):
+        kwargs = dict(
+            updates=args.updates,
+            chats=args.chats,
+            workers=args.workers,
+            latency=args.latency,
+            rate_limit_every=args.rate_limit_every,
+            reply=not args.no_reply,
+            ordered=args.ordered,
+        )
+        _print("end to end", asyncio.run(end_to_end.run(**kwargs)))
+        # traced separately, tracing slows everything down
+        memory = asyncio.run(end_to_end.run(trace_memory=True, **kwargs))
+        _print(
+            "memory",
+            {"peak_bytes_per_update": memory["peak_bytes_per_update"]},
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import asyncio
+import timeit
+from typing import Callable, Dict
+
+from .. import json_codec
+from ..bot import Bot
+from ..bot_types import convert_dict
+from .fake_server import make_update
+
+
+def _measure(func: Callable, number: int) -> float:
+    """
+    Best of three, in microseconds per call.
+    """
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def run(number: int = 100000) -> Dict[str, float]:
+    update = make_update(1, 1)
+    raw = update["message"]
+    encoded = json_codec.dumps({"ok": True, "result": [update] * 100})
+    message = convert_dict(raw, "message")
+
+    def access():
+        m = convert_dict(raw, "message")
+        return m.text, m.chat.id, m.from_user.id, m.entities[0].type
+
+    bot = Bot("0:bench", 1, rate_limiter=False)
+    # what start would look up, dispatch makes no requests then
+    bot.username = "bench_bot"
+
+    @bot.register("onMessage", commands="start")
+    async def on_start(message):
+        pass
+
+    @bot.register("onMessage")
+    async def on_message(message):
+        pass
+
+    loop = asyncio.new_event_loop()
+    try:
+        dispatch = _measure(
+            lambda: loop.run_until_complete(bot._handle_update(update)),
+            number // 10,
+        )
+    finally:
+        loop.close()
+    return {
+        "convert_dict_us": _measure(
+            lambda: convert_dict(raw, "message"), number
+        ),
+        "convert_and_access_us": _measure(access, number),
+        "to_dict_us": _measure(message.to_dict, number),
+        "decode_100_updates_us": _measure(
+            lambda: json_codec.loads(encoded), number // 100
+        ),
+        "handle_update_us": dispatch,
+    }
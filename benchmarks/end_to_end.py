@@ -0,0 +1,92 @@
+import asyncio
+import time
+import tracemalloc
+from typing import List
+
+from ..bot import Bot
+from .fake_server import FakeBotAPI
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def run(
+    updates: int = 10000,
+    chats: int = 100,
+    workers: int = 16,
+    latency: float = 0.0,
+    rate_limit_every: int = 0,
+    reply: bool = True,
+    ordered: bool = False,
+    trace_memory: bool = False,
+    **bot_kwargs
+) -> dict:
+    """
+    Polls `updates` updates from a FakeBotAPI, answering every one of
+    them with send_message when `reply` is set, and returns the
+    throughput, the handler and the end to end (served by getUpdates
+    until handled) latencies, and with `trace_memory` the traced
+    memory peak per update.
+    """
+    server = FakeBotAPI(
+        updates=updates,
+        chats=chats,
+        latency=latency,
+        rate_limit_every=rate_limit_every,
+    )
+    await server.start()
+    bot = Bot(
+        "0:bench",
+        workers,
+        api_url=server.url,
+        poll_timeout=1,
+        ordered=ordered,
+        rate_limiter=False,
+        **bot_kwargs
+    )
+    durations = []
+    delays = []
+    finished = asyncio.Event()
+
+    async def handler(message):
+        started = time.perf_counter()
+        if reply:
+            await bot.send_message(message.chat.id, message.text)
+        now = time.perf_counter()
+        durations.append(now - started)
+        delays.append(now - server.served[message.message_id])
+        if len(durations) == updates:
+            finished.set()
+
+    bot.register("onMessage")(handler)
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        await bot.start()
+        await finished.wait()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        await bot.stop(timeout=5)
+        await server.stop()
+    result = {
+        "updates": updates,
+        "seconds": elapsed,
+        "updates_per_second": updates / elapsed,
+        "handler_p50_ms": percentile(durations, 0.5) * 1000,
+        "handler_p99_ms": percentile(durations, 0.99) * 1000,
+        "end_to_end_p50_ms": percentile(delays, 0.5) * 1000,
+        "end_to_end_p99_ms": percentile(delays, 0.99) * 1000,
+        "sent": server.sent,
+        "rate_limited": server.rate_limited,
+    }
+    if trace_memory:
+        result["peak_bytes_per_update"] = peak / updates
+    return result
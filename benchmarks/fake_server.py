@@ -0,0 +1,155 @@
+import asyncio
+import time
+from typing import Union
+
+from aiohttp import web
+
+from .. import json_codec
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    """
+    A text message with a command and a mention, about the size
+    of an average update.
+    """
+    text = "/start@bench_bot hello @someone, see https://example.com"
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "from": {
+                "id": chat_id,
+                "is_bot": False,
+                "first_name": "User",
+                "username": "user%d" % chat_id,
+                "language_code": "en",
+            },
+            "chat": {
+                "id": chat_id,
+                "first_name": "User",
+                "username": "user%d" % chat_id,
+                "type": "private",
+            },
+            "text": text,
+            "entities": [
+                {"offset": 0, "length": 16, "type": "bot_command"},
+                {"offset": 23, "length": 8, "type": "mention"},
+                {"offset": 38, "length": 19, "type": "url"},
+            ],
+        },
+    }
+
+
+class FakeBotAPI:
+    """
+    Serves `updates` synthetic updates from `chats` chats on
+    getUpdates and accepts every other method. Each request takes
+    `latency` seconds, and every `rate_limit_every`-th send is
+    answered with a 429 asking to retry after `retry_after` seconds.
+
+    Point a Bot at it with api_url=server.url.
+    """
+
+    def __init__(
+        self,
+        updates: int = 10000,
+        chats: int = 100,
+        latency: float = 0.0,
+        rate_limit_every: int = 0,
+        retry_after: int = 1,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.updates = updates
+        self.chats = chats
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+        self.sent = 0
+        self.rate_limited = 0
+        # update_id -> perf_counter() of when it was first served
+        self.served = {}
+        self._runner: Union[web.AppRunner, None] = None
+
+    @property
+    def url(self) -> str:
+        return "http://%s:%d" % (self.host, self.port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # the real port, when it was picked by the system
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _reply(self, result) -> web.Response:
+        return web.Response(
+            body=json_codec.dumps({"ok": True, "result": result}),
+            content_type="application/json",
+        )
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if method == "getUpdates":
+            return await self._get_updates(data)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ("setWebhook", "deleteWebhook"):
+            return self._reply(True)
+        self.sent += 1
+        if self.rate_limit_every and self.sent % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            return web.Response(
+                status=429,
+                body=json_codec.dumps(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests: retry after %d"
+                        % self.retry_after,
+                        "parameters": {"retry_after": self.retry_after},
+                    }
+                ),
+                content_type="application/json",
+            )
+        chat_id = data.get("chat_id", 0)
+        return self._reply(
+            {
+                "message_id": self.sent,
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        )
+
+    async def _get_updates(self, data) -> web.Response:
+        offset = max(int(data.get("offset", 0)), 1)
+        limit = int(data.get("limit", 100))
+        end = min(offset + limit, self.updates + 1)
+        if offset >= end:
+            # nothing left, hold the request like Telegram does
+            await asyncio.sleep(min(float(data.get("timeout", 0)), 1))
+            return self._reply([])
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        now = time.perf_counter()
+        for update_id in range(offset, end):
+            self.served.setdefault(update_id, now)
+        return self._reply(
+            [
+                make_update(update_id, update_id % self.chats + 1)
+                for update_id in range(offset, end)
+            ]
+        )
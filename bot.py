@@ -1,12 +1,97 @@
 import asyncio
-import json
+import inspect
 import logging
-import traceback
-from typing import Any, List, Union
+import math
+import os
+import random
+import signal
+import time
+from collections import deque
+from contextlib import nullcontext
+from functools import partial
+from typing import (
+    Any,
+    AsyncIterable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Pattern,
+    Union,
+)
 
 import aiohttp
 
-from .bot_types import convert_dict
+from . import json_codec
+from .bot_types import (
+    HANDLER_UPDATES,
+    TYPES,
+    UPDATE_TYPES,
+    Chat,
+    Handlers,
+    User,
+    convert_dict,
+    get_update_key,
+)
+from .broadcast import Broadcast, BroadcastStats
+from .cache import CACHE_UPDATES, CHAT_CHANGES, RequestCache
+from .coalesce import Coalescer
+from .entities import to_html
+from .files import FileIdCache, InputFile, as_input_file
+from .filters import Filter, Router, parse_command
+from .lifecycle import cancel_tasks
+from .metrics import Metrics
+from .offset_store import OffsetStore, UpdateTracker
+from .pipeline import PendingResult, Pipeline
+from .rate_limiter import RateLimiter
+from .state_storage import FSMContext, StateStorage, current_state, state_var
+from .update_queue import UpdateQueue
+from .webhook import WebhookServer, base_url
+
+# seconds before a failed getMe for the bot's username is tried again
+USERNAME_RETRY = 60.0
+
+
+def make_session(
+    limit: int,
+    limit_per_host: int = 0,
+    dns_cache_ttl: Union[int, None] = 300,
+    keepalive_timeout: float = 30,
+) -> aiohttp.ClientSession:
+    """
+    Session with a pool of `limit` connections (0 for no limit),
+    resolved hosts are kept `dns_cache_ttl` seconds (None: no cache).
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            ttl_dns_cache=dns_cache_ttl,
+            use_dns_cache=dns_cache_ttl is not None,
+            keepalive_timeout=keepalive_timeout,
+        )
+    )
+
+
+async def wait_for_signal():
+    """
+    Returns on SIGINT or SIGTERM.
+    """
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stopping.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows, or not the main thread
+    try:
+        await stopping.wait()
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.remove_signal_handler(signum)
+            except (NotImplementedError, RuntimeError):
+                pass
 
 
 class Poller:
@@ -17,44 +102,232 @@ class Poller:
         session,
         api_url: str = "api.telegram.org",
         skip_updates: bool = False,
+        timeout: int = 30,
+        limit: int = 100,
+        allowed_updates: Union[
+            Callable[[], List[str]], List[str], None
+        ] = None,
+        backoff_min: float = 0.5,
+        backoff_max: float = 30.0,
+        metrics: Union[Metrics, None] = None,
+        tracker: Union[UpdateTracker, None] = None,
+        offset_store: Union[OffsetStore, None] = None,
+        sync_interval: float = 5.0,
     ):
         self.queue = queue
         self.token = token
         self.session = session
-        self.api_url = "https://" + api_url + "/bot"
+        self.api_url = base_url(api_url) + "/bot"
         self.skip_updates = skip_updates
+        self.timeout = timeout
+        self.limit = limit
+        # either a list or a callable, so handlers registered
+        # after start are picked up on the next poll
+        self.allowed_updates = allowed_updates
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.metrics = metrics
+        self.tracker = tracker
+        self.offset_store = offset_store
+        self.sync_interval = sync_interval
+        self._saved_offset = None
+        self.tasks: List[asyncio.Task] = []
+        # first update of a batch that was cut short by stop()
+        self.unqueued: Union[int, None] = None
         self.logger = logging.getLogger()
 
     async def make_request(self, method, data):
         async with self.session.post(
-            self.api_url + self.token + "/" + method, data=data
+            self.api_url + self.token + "/" + method,
+            data=data,
+            # the server holds the request for up to `timeout` seconds
+            timeout=aiohttp.ClientTimeout(total=self.timeout + 10),
         ) as post:
-            a = await post.json()
+            a = json_codec.loads(await post.read())
             logging.debug(a)
             return a
 
+    def _params(self, offset: int, timeout: int) -> dict:
+        params = {"offset": offset, "timeout": timeout}
+        if self.limit is not None:
+            params["limit"] = self.limit
+        allowed_updates = self.allowed_updates
+        if callable(allowed_updates):
+            allowed_updates = allowed_updates()
+        if allowed_updates is not None:
+            params["allowed_updates"] = json_codec.dumps(allowed_updates)
+        return params
+
+    def _backoff(self, failures: int) -> float:
+        # exponential backoff with "equal jitter", so that
+        # several bots failing at once don't retry in lockstep
+        delay = min(self.backoff_max, self.backoff_min * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
     async def _worker(self, skip_updates: bool):
-        offset = -1
+        # -1 makes Telegram forget everything but the last update,
+        # which is only wanted when skipping the backlog anyway
+        offset = -1 if skip_updates else 0
+        if self.offset_store is not None and not skip_updates:
+            stored = await asyncio.get_running_loop().run_in_executor(
+                None, self.offset_store.load
+            )
+            if stored is not None:
+                offset = stored
+        # with an offset store, only handled updates are confirmed
+        # to Telegram, the rest are delivered again after a restart
+        durable = self.offset_store is not None and self.tracker is not None
         to_skip = skip_updates
+        failures = 0
         while True:
             try:
-                res = await self.make_request("getUpdates", {"offset": offset})
-                if "result" not in res:
-                    self.logger.debug(res)
-                for i in res["result"]:
-                    offset = i["update_id"] + 1
+                if durable:
+                    watermark = self.tracker.watermark()
+                    if watermark is not None:
+                        offset = watermark
+                started = time.perf_counter()
+                # the skipping poll must not wait: whatever comes in
+                # while it is held open is new and would be skipped
+                res = await self.make_request(
+                    "getUpdates",
+                    self._params(offset, 0 if to_skip else self.timeout),
+                )
+                if self.metrics is not None:
+                    self.metrics.observe(
+                        "poll_seconds", time.perf_counter() - started
+                    )
+                if not res.get("ok"):
+                    retry_after = res.get("parameters", {}).get("retry_after")
+                    if retry_after:
+                        await asyncio.sleep(retry_after)
+                        continue
+                    raise RuntimeError("getUpdates failed: %s" % res)
+                new = 0
+                for n, i in enumerate(res["result"]):
+                    update_id = i["update_id"]
+                    offset = max(offset, update_id + 1)
+                    if self.tracker is not None:
+                        if self.tracker.seen(update_id):
+                            continue
+                        self.tracker.begin(update_id)
                     if to_skip:
+                        if self.tracker is not None:
+                            self.tracker.done(update_id)
                         continue
-                    self.queue.put_nowait(i)
-                to_skip = False
+                    new += 1
+                    try:
+                        # blocks while a bounded queue is full
+                        await self.queue.put(i)
+                    except asyncio.CancelledError:
+                        self._unqueued(res["result"][n:])
+                        raise
+                if to_skip:
+                    to_skip = False
+                    # nothing was pending, -1 would keep dropping all
+                    # but the last update of every following batch
+                    offset = max(offset, 0)
+                failures = 0
+                if durable and res["result"]:
+                    await self._wait_for_room(
+                        len(res["result"]) >= (self.limit or 100)
+                    )
+            except Exception:
+                self.logger.exception("getUpdates failed")
+                if self.metrics is not None:
+                    self.metrics.inc("poll_errors")
+                failures += 1
+                await asyncio.sleep(self._backoff(failures))
+
+    async def _wait_for_room(self, full: bool):
+        """
+        Durable polls start at the watermark, so every update still
+        being handled is downloaded again, and Telegram answers at
+        once instead of holding the poll. Waits (up to the poll
+        timeout) until at least half of a batch can be new, or until
+        few updates are left to handle and the workers need more.
+        After a batch that wasn't `full` there is nothing more to
+        fetch, then it waits until everything is handled.
+
+        An update that is never done holds the watermark, and once
+        `limit` newer ones are pending nothing new can be fetched,
+        which is why durable mode wants a handler_timeout.
+        """
+        limit = self.limit or 100
+        tracker = self.tracker
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while True:
+            watermark = tracker.watermark()
+            if not tracker.pending or (
+                full
+                and (
+                    tracker.highest + 1 - watermark <= limit // 2
+                    or len(tracker.pending) <= limit // 4
+                )
+            ):
+                return
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            await tracker.wait_progress(watermark, remaining)
+
+    def _unqueued(self, updates: List[dict]):
+        # not handled, so not to be confirmed, but not waited for
+        self.unqueued = updates[0]["update_id"]
+        if self.tracker is not None:
+            for i in updates:
+                self.tracker.done(i["update_id"])
+
+    async def save_offset(self, watermark: Union[int, None] = None):
+        if self.offset_store is None or self.tracker is None:
+            return
+        if watermark is None:
+            watermark = self.tracker.watermark()
+        if watermark is not None and watermark != self._saved_offset:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.offset_store.save, watermark
+            )
+            self._saved_offset = watermark
+
+    async def _sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.save_offset()
             except Exception:
-                traceback.print_exc()
+                self.logger.exception("Saving offset failed")
 
     async def start(self):
-        asyncio.create_task(self._worker(self.skip_updates))
+        self.tasks = [asyncio.create_task(self._worker(self.skip_updates))]
+        if self.offset_store is not None:
+            self.tasks.append(asyncio.create_task(self._sync()))
+
+    async def stop(self):
+        tasks, self.tasks = self.tasks, []
+        await cancel_tasks(tasks)
+
+    async def ack(self, offset: int):
+        """
+        Confirms every update before `offset` to Telegram,
+        which otherwise only happens with the next poll.
+        """
+        res = await self.make_request(
+            "getUpdates", {"offset": offset, "limit": 1, "timeout": 0}
+        )
+        if not res.get("ok"):
+            raise RuntimeError("getUpdates failed: %s" % res)
 
 
 class Worker:
+    """
+    Runs `workers_amount` tasks handling updates from the queue.
+
+    With `max_workers` above that, the pool resizes itself every
+    `scale_interval` seconds between the two, to as many workers as
+    the incoming rate times the handling latency asks for, plus
+    enough to work off the backlog. `size` is the current amount.
+    """
+
     def __init__(
         self,
         token: str,
@@ -62,23 +335,215 @@ class Worker:
         workers_amount: int,
         session,
         handle_update,
+        max_workers: Union[int, None] = None,
+        scale_interval: float = 1.0,
     ):
         self.token = token
         self.queue = queue
         self.workers_amount = workers_amount
+        self.max_workers = max(max_workers or 0, workers_amount)
+        self.scale_interval = scale_interval
         self.session = session
         self.handle_update = handle_update
+        self.tasks: set = set()
+        self.idle: set = set()
+        self.busy = 0
+        # moving average of seconds per update
+        self.latency = 0.0
+        self._handled = 0
+        self._last_backlog = 0
+        self._scaler_task: Union[asyncio.Task, None] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.tasks)
+
+    def _take(self):
+        return self.queue.get()
+
+    async def _process(self, upd: dict):
+        await self.handle_update(upd)
 
-        # print(update)
+    def _backlog(self) -> int:
+        return self.queue.qsize()
+
+    def pending(self) -> int:
+        """
+        Updates taken from the queue and not handled yet.
+        """
+        return self.busy
 
     async def _worker(self):
+        task = asyncio.current_task()
         while True:
+            self.idle.add(task)
+            try:
+                item = await self._take()
+            finally:
+                self.idle.discard(task)
+            self.busy += 1
+            started = time.perf_counter()
+            try:
+                await self._process(item)
+            finally:
+                self.busy -= 1
+                self._handled += 1
+                self.latency += 0.2 * (
+                    time.perf_counter() - started - self.latency
+                )
+
+    def _spawn(self):
+        task = asyncio.create_task(self._worker())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _target(self) -> int:
+        handled, self._handled = self._handled, 0
+        backlog = self._backlog()
+        arrived = max(handled + backlog - self._last_backlog, 0)
+        self._last_backlog = backlog
+        # Little's law: busy workers = arrival rate * latency
+        needed = (arrived + backlog) * self.latency / self.scale_interval
+        target = math.ceil(needed * 1.25)
+        if backlog and not self.idle:
+            # everyone is stuck, the latency can't tell yet how long
+            target = max(target, self.size + max(self.size // 2, 1))
+        else:
+            # shrink gradually, traffic comes in waves
+            target = max(target, self.size - max(self.size // 4, 1))
+        return min(max(target, self.workers_amount), self.max_workers)
+
+    async def _scaler(self):
+        while True:
+            await asyncio.sleep(self.scale_interval)
+            target = self._target()
+            for _ in range(target - self.size):
+                self._spawn()
+            # only idle workers are stopped, nothing is interrupted
+            for task in list(self.idle)[: self.size - target]:
+                self.idle.discard(task)
+                task.cancel()
+
+    async def start(self):
+        for _ in range(self.workers_amount):
+            self._spawn()
+        if self.max_workers > self.workers_amount:
+            self._scaler_task = asyncio.create_task(self._scaler())
+
+    async def stop(self):
+        tasks = list(self.tasks)
+        if self._scaler_task is not None:
+            tasks.append(self._scaler_task)
+            self._scaler_task = None
+        await cancel_tasks(tasks)
+
+
+class OrderedWorker(Worker):
+    """
+    Updates of one chat are handled one at a time in the order
+    they came in, while different chats are handled in parallel.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        queue: asyncio.Queue,
+        workers_amount: int,
+        session,
+        handle_update,
+        lane_size: int = 100,
+        max_workers: Union[int, None] = None,
+        scale_interval: float = 1.0,
+    ):
+        super().__init__(
+            token,
+            queue,
+            workers_amount,
+            session,
+            handle_update,
+            max_workers=max_workers,
+            scale_interval=scale_interval,
+        )
+        self.lane_size = lane_size
+        # key -> pending updates, present while the key is scheduled
+        self.lanes: Dict[Any, deque] = {}
+        self.held = 0  # updates in all lanes together
+        # keys that have something to handle, each at most once
+        self.ready = asyncio.Queue()
+        self._freed = asyncio.Event()
+        self._distributor_task: Union[asyncio.Task, None] = None
+
+    async def _distributor(self):
+        limit = self.queue.maxsize
+        while True:
+            # the lanes count against the queue bound, so that updates
+            # back up in the queue, where its overflow policy applies
+            while limit > 0 and self.held >= limit:
+                self._freed.clear()
+                await self._freed.wait()
             upd = await self.queue.get()
+            key = get_update_key(upd)
+            while True:
+                lane = self.lanes.get(key)
+                if lane is None:
+                    self.lanes[key] = deque((upd,))
+                    self.held += 1
+                    self.ready.put_nowait(key)
+                    break
+                if len(lane) < self.lane_size:
+                    lane.append(upd)
+                    self.held += 1
+                    break
+                # the lane is full, hold off reading the shared queue
+                self._freed.clear()
+                await self._freed.wait()
+
+    def _take(self):
+        return self.ready.get()
+
+    def _backlog(self) -> int:
+        # lanes waiting for a worker, a lane is only handled by one
+        return self.ready.qsize()
+
+    def pending(self) -> int:
+        # lanes hold the one being handled until it is done
+        return self.held + self.busy
+
+    async def _process(self, key):
+        lane = self.lanes[key]
+        upd = lane.popleft()
+        self.held -= 1
+        self._freed.set()
+        try:
             await self.handle_update(upd)
+        finally:
+            if lane:
+                # back of the line, so busy chats take turns
+                self.ready.put_nowait(key)
+            else:
+                del self.lanes[key]
 
     async def start(self):
-        for _ in range(self.workers_amount):
-            asyncio.create_task(self._worker())
+        await super().start()
+        self._distributor_task = asyncio.create_task(self._distributor())
+
+    async def stop(self):
+        if self._distributor_task is not None:
+            await cancel_tasks([self._distributor_task])
+            self._distributor_task = None
+        await super().stop()
+
+
+class _Background:
+    """
+    Marks a handler registered with background=True in the dispatch
+    table, so that it gets its own task instead of being awaited.
+    """
+
+    __slots__ = ("func",)
+
+    def __init__(self, func: Callable):
+        self.func = func
 
 
 class Bot:
@@ -88,127 +553,462 @@ class Bot:
         n: int,
         api_url: Union[str, None] = "api.telegram.org",
         skip_updates: bool = False,
+        poll_timeout: int = 30,
+        poll_limit: int = 100,
+        ordered: bool = False,
+        lane_size: int = 100,
+        queue_size: int = 0,
+        overflow: str = "block",
+        shed_types: Iterable[str] = (),
+        coalesce_edits: bool = False,
+        rate_limiter: Union[RateLimiter, bool] = True,
+        session: Union[aiohttp.ClientSession, None] = None,
+        metrics: Union[Metrics, None] = None,
+        offset_store: Union[OffsetStore, None] = None,
+        offset_sync_interval: float = 5.0,
+        dedup_size: int = 10000,
+        file_id_cache_size: int = 1024,
+        coalesce_window: float = 0,
+        pool_size: int = 100,
+        pool_size_per_host: int = 0,
+        dns_cache_ttl: Union[int, None] = 300,
+        keepalive_timeout: float = 30,
+        separate_poll_session: bool = True,
+        handler_timeout: Union[float, None] = None,
+        update_timeout: Union[float, None] = None,
+        on_error: Union[Callable[[Exception, dict, Any], Any], None] = None,
+        max_workers: Union[int, None] = None,
+        scale_interval: float = 1.0,
+        storage: Union[StateStorage, None] = None,
+        cache_size: int = 10000,
+        cache_ttl: float = 60,
     ):
-        self.queue = asyncio.Queue()
+        if offset_store is not None and handler_timeout is None:
+            logging.warning(
+                "With an offset_store, a handler that never finishes "
+                "stops polling, set a handler_timeout"
+            )
+        self.tracker = UpdateTracker(dedup_size)
+        self.queue = UpdateQueue(
+            queue_size,
+            overflow=overflow,
+            shed_types=shed_types,
+            coalesce_edits=coalesce_edits,
+            metrics=metrics,
+            on_drop=self.tracker.done,
+        )
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.gauge("queue_depth", self.queue.qsize)
         if not isinstance(token, str) or len(token) == 0:
             raise ValueError("A valid token must be provided.")
         self.token = token
-        self.session: aiohttp.ClientSession = aiohttp.ClientSession()
+        # sessions are created by open() inside the running loop,
+        # a session passed in belongs to the caller and is not closed
+        self.session: Union[aiohttp.ClientSession, None] = session
+        self.poll_session: Union[aiohttp.ClientSession, None] = None
+        self._own_session = session is None
+        self._own_poll_session = True
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.separate_poll_session = separate_poll_session
         self.poller = Poller(
-            token, self.queue, self.session, skip_updates=skip_updates
+            token,
+            self.queue,
+            None,
+            api_url=api_url,
+            skip_updates=skip_updates,
+            timeout=poll_timeout,
+            limit=poll_limit,
+            allowed_updates=self.allowed_updates,
+            metrics=metrics,
+            tracker=self.tracker,
+            offset_store=offset_store,
+            sync_interval=offset_sync_interval,
+        )
+        if ordered:
+            self.worker = OrderedWorker(
+                token,
+                self.queue,
+                n,
+                None,
+                self._handle_update,
+                lane_size=lane_size,
+                max_workers=max_workers,
+                scale_interval=scale_interval,
+            )
+        else:
+            self.worker = Worker(
+                token,
+                self.queue,
+                n,
+                None,
+                self._handle_update,
+                max_workers=max_workers,
+                scale_interval=scale_interval,
+            )
+        if metrics is not None:
+            metrics.gauge("workers", lambda: self.worker.size)
+            metrics.gauge("workers_busy", lambda: self.worker.busy)
+        self.api_url = base_url(api_url) + "/bot"
+        self.file_url = base_url(api_url) + "/file/bot"
+        self.file_ids = FileIdCache(file_id_cache_size)
+        # with a window, edits and callback answers are coalesced
+        self.coalescer: Union[Coalescer, None] = (
+            Coalescer(self._send_coalesced, coalesce_window)
+            if coalesce_window > 0
+            else None
+        )
+        self.webhook: Union[WebhookServer, None] = None
+        self.pipeline = Pipeline(self._send_pipelined)
+        if rate_limiter is True:
+            rate_limiter = RateLimiter()
+        self.limiter: Union[RateLimiter, None] = rate_limiter or None
+        self._raw_api_url = api_url
+        self.skip_updates = skip_updates
+        self._filters: Dict[tuple, Filter] = {}
+        self._background: set = set()
+        self.background_tasks: set = set()
+        # seconds a single handler / all handlers of an update may take
+        self.handler_timeout = handler_timeout
+        self.update_timeout = update_timeout
+        # called with (exception, update, handler) when a handler fails
+        # or times out, handler is None for the update deadline
+        self.on_error = on_error
+        # per (chat, user) conversation state, see state_storage
+        self.storage = storage
+        # looked up by start when there are command handlers, or when
+        # a command addressed to a bot comes in (webhook, BotHost)
+        self.username: Union[str, None] = None
+        self._username_retry = 0.0  # monotonic time of the next getMe
+        # getMe, getChat... results, cache_ttl=0 turns it off; polling
+        # and the webhook ask for the member updates that invalidate it
+        # from the first member or admin lookup on
+        self.cache: Union[RequestCache, None] = (
+            RequestCache(cache_size, cache_ttl) if cache_ttl > 0 else None
         )
-        self.worker = Worker(
-            token, self.queue, n, self.session, self._handle_update
+        self._member_updates = False
+        self._build_dispatch()
+
+    def _make_session(self, limit: int) -> aiohttp.ClientSession:
+        return make_session(
+            limit,
+            self.pool_size_per_host,
+            self.dns_cache_ttl,
+            self.keepalive_timeout,
         )
-        self.api_url = "https://" + api_url + "/bot"
 
-    def __del__(self):
-        asyncio.run(self.session.close())
+    async def open(self):
+        """
+        Creates the HTTP sessions. Called by start and by the first
+        request, so it is only needed to open them ahead of time.
+        """
+        if self.session is None:
+            self.session = self._make_session(self.pool_size)
+        if self.poll_session is None:
+            # long polls hold their connection for the whole timeout,
+            # so they get a small pool of their own and never wait
+            # behind outgoing requests (or make those wait)
+            if self.separate_poll_session:
+                self.poll_session = self._make_session(2)
+            else:
+                self.poll_session = self.session
+        self.poller.session = self.poll_session
+        self.worker.session = self.session
+
+    def use_sessions(
+        self,
+        session: aiohttp.ClientSession,
+        poll_session: Union[aiohttp.ClientSession, None] = None,
+    ):
+        """
+        Makes the bot use sessions that belong to someone else (a
+        BotHost, say), close() leaves them open.
+        """
+        self.session = session
+        self.poll_session = poll_session or session
+        self._own_session = False
+        self._own_poll_session = False
+        self.poller.session = self.poll_session
+        self.worker.session = self.session
+
+    async def close(self):
+        if self.poll_session is not None:
+            shared = self.poll_session is self.session
+            if self._own_poll_session and not shared:
+                await self.poll_session.close()
+            self.poll_session = None
+        if self.session is not None and self._own_session:
+            await self.session.close()
+            self.session = None
+        if self.storage is not None:
+            await self.storage.close()
+
+    @property
+    def state(self) -> Union[FSMContext, None]:
+        """
+        FSMContext of the update being handled, for use in handlers.
+        Updates of one chat can be handled at the same time and
+        overwrite each other's changes, unless ordered=True.
+        """
+        return current_state()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     # this function is a decorator, that's why it is so strange
-    def register(self, method):
+    def register(
+        self,
+        method,
+        commands: Union[str, Iterable[str], None] = None,
+        regex: Union[str, Pattern, None] = None,
+        chat_types: Union[str, Iterable[str], None] = None,
+        content_types: Union[str, Iterable[str], None] = None,
+        callback_data: Union[str, None] = None,
+        state: Union[str, Iterable[str], None] = None,
+        background: bool = False,
+    ):
+        """
+        The handler is called only for updates that pass all of
+        the given filters, e.g. register("onMessage", commands="start")
+        or register("onCallbackQuery", callback_data="page:")
+        or register("onMessage", state="ask_name").
+
+        A background handler runs on its own, the worker doesn't
+        wait for it and the update counts as handled without it.
+        handler_timeout applies to it as well.
+        """
+        flt = Filter(
+            commands=commands,
+            regex=regex,
+            chat_types=chat_types,
+            content_types=content_types,
+            callback_data=callback_data,
+            state=state,
+        )
+        if flt.empty():
+            flt = None
+
         def a(func, preserved=self):
             setattr(preserved, method, getattr(preserved, method) + [func])
+            if flt is not None:
+                preserved._filters[(method, func)] = flt
+            if background:
+                preserved._background.add((method, func))
+            preserved._build_dispatch()
             return func
 
         return a
 
     def load_module(self, module):
+        module.storage = self.storage
         for i in module.get_funcs():
-            self.register(i[1])(i[0])
-
-    def apply_entities(self, text: str, entities: list):
-        raise NotImplementedError  # It doesn't work well for now.
-        print("TEXT", text)
-        print("ENTITIES", entities)
-        for i in entities:
-            entity_type = i["type"]
-            length = i["length"]
-            offset = i["offset"]
-            tags = ("", "")
-            if entity_type == "bold":
-                tags = ("<b>", "</b>")
-            elif entity_type == "code":
-                tags = ("<code>", "</code>")
-            text = (
-                text[:offset]
-                + tags[0]
-                + text[offset : offset + length]  # noqa: E203
-                + tags[1]
-                + text[offset + length :]  # noqa: E203
+            # [func, handler] or [func, handler, {filters}]
+            self.register(i[1], **(i[2] if len(i) > 2 else {}))(i[0])
+
+    def allowed_updates(self) -> List[str]:
+        """
+        Update types that at least one registered
+        handler is interested in, and once members or admins
+        are cached, the member updates that keep them up to date.
+        """
+        types = []
+        for handler, updates in HANDLER_UPDATES.items():
+            if getattr(self, handler):
+                types += [i for i in updates if i not in types]
+        if self._member_updates:
+            # never sent unless asked for, with or without handlers
+            types += [i for i in CACHE_UPDATES if i not in types]
+        return types
+
+    def apply_entities(self, text: str, entities: list) -> str:
+        """
+        Text with its entities as HTML, for parse_mode="HTML".
+        """
+        return to_html(text, entities)
+
+    def _build_dispatch(self):
+        # update type -> (converter, router), rebuilt on every
+        # register so that _handle_update does a single dict lookup
+        handlers = {}
+        for handler, updates in HANDLER_UPDATES.items():
+            if handler == Handlers.onRaw:
+                continue
+            for update_type in updates:
+                handlers.setdefault(update_type, [])
+                handlers[update_type] += [
+                    (
+                        _Background(func)
+                        if (handler, func) in self._background
+                        else func,
+                        self._filters.get((handler, func)),
+                    )
+                    for func in getattr(self, handler)
+                ]
+        self._dispatch = {
+            update_type: (
+                TYPES.get(UPDATE_TYPES[update_type]),
+                Router(funcs),
             )
-        return text
+            for update_type, funcs in handlers.items()
+            if funcs
+        }
+        self._raw_handlers = tuple(
+            _Background(func)
+            if (Handlers.onRaw, func) in self._background
+            else func
+            for func in self.onRaw
+        )
 
     async def _handle_update(self, update: dict):
+        # the context of the worker task is reused between updates
+        previous = state_var.set(None)
         try:
+            calls = []
+            for key, value in update.items():
+                if key == "update_id":
+                    continue
+                if self.metrics is not None:
+                    self.metrics.inc("updates", type=key)
+                if self.cache is not None and isinstance(value, dict):
+                    self._invalidate(key, value)
+                entry = self._dispatch.get(key)
+                if entry is not None:
+                    converter, router = entry
+                    if (
+                        self.username is None
+                        and router.commands
+                        and time.monotonic() >= self._username_retry
+                    ):
+                        command = parse_command(value)
+                        if command is not None and command[1] is not None:
+                            # "/cmd@name" can be meant for another bot
+                            await self._load_username()
+                    if self.storage is not None and isinstance(value, dict):
+                        # looked up once, seen by filters and handlers
+                        state_var.set(await self.storage.load(value))
+                    # converted once and shared between all handlers
+                    if converter is not None:
+                        value = converter(value)
+                    calls += [
+                        (func, value)
+                        for func in router.match(value, self.username)
+                    ]
+                elif key not in UPDATE_TYPES:
+                    logging.error("Unknown update type: %s" % key)
+                break
+            calls += [(func, update) for func in self._raw_handlers]
             tasks = []
-            if "message" in update:
-                print(update)
-                tasks += [
-                    func(convert_dict(update["message"], "message"))
-                    for func in self.onMessage
-                ]
-                tasks += [
-                    func(convert_dict(update["message"], "message"))
-                    for func in self.onMessageOnly
-                ]
-            elif "edited_message" in update:
-                tasks += [
-                    func(convert_dict(update["edited_message"], "message"))
-                    for func in self.onMessage
-                ]
-                tasks += [
-                    func(convert_dict(update["edited_message"], "message"))
-                    for func in self.onEditedMessage
-                ]
-            elif "channel_post" in update:
-                tasks += [
-                    func(convert_dict(update["channel_post"], "message"))
-                    for func in self.onMessage
-                ]
-                tasks += [
-                    func(convert_dict(update["channel_post"], "message"))
-                    for func in self.onChannelPost
-                ]
-            elif "edited_channel_post" in update:
-                tasks += [
-                    func(
-                        convert_dict(update["edited_channel_post"], "message")
+            for func, value in calls:
+                if isinstance(func, _Background):
+                    task = asyncio.create_task(
+                        self._run_handler(func.func, value, update)
                     )
-                    for func in self.onMessage
-                ]
-                tasks += [
-                    func(
-                        convert_dict(update["edited_channel_post"], "message")
-                    )
-                    for func in self.onEditedChannelPost
-                ]
-            elif "inline_query" in update:
-                tasks += [
-                    func(update["inline_query"]) for func in self.onInlineQuery
-                ]
-            elif "chosen_inline_result" in update:
-                tasks += [
-                    func(update["chosen_inline_result"])
-                    for func in self.onChosenInlineResult
-                ]
-            elif "callback_query" in update:
-                tasks += [
-                    func(
-                        convert_dict(
-                            update["callback_query"], "callback_query"
-                        )
-                    )
-                    for func in self.onCallbackQuery
-                ]
-            else:
-                logging.error(
-                    "Unknown update type: %s" % list(update.keys())[1]
+                    self.background_tasks.add(task)
+                    task.add_done_callback(self.background_tasks.discard)
+                else:
+                    tasks.append(self._run_handler(func, value, update))
+            if self.update_timeout is None:
+                await asyncio.gather(*tasks)
+            elif tasks:
+                tasks = [asyncio.ensure_future(task) for task in tasks]
+                _, pending = await asyncio.wait(
+                    tasks, timeout=self.update_timeout
                 )
-            tasks += [func(update) for func in self.onRaw]
-            await asyncio.gather(*tasks)
+                if pending:
+                    await cancel_tasks(pending)
+                    await self._report(
+                        asyncio.TimeoutError(
+                            "%d handler(s) cancelled after %ss"
+                            % (len(pending), self.update_timeout)
+                        ),
+                        update,
+                        None,
+                    )
+        except Exception as e:
+            await self._report(e, update, None)
+        finally:
+            state_var.reset(previous)
+            self.tracker.done(update.get("update_id"))
+
+    def _invalidate(self, update_type: str, value: dict):
+        chat = value.get("chat")
+        if chat is None or not self.cache.has_chat(chat["id"]):
+            return
+        if update_type in CACHE_UPDATES:
+            user_id = value["new_chat_member"]["user"]["id"]
+            self.cache.invalidate(("getChatMember", chat["id"], user_id))
+            self.cache.invalidate(("getChatAdministrators", chat["id"]))
+            self.cache.invalidate(("getChat", chat["id"]))
+        elif any(i in value for i in CHAT_CHANGES):
+            self.cache.invalidate_chat(chat["id"])
+
+    async def _load_username(self):
+        # set first, so that updates coming in meanwhile don't ask
+        # again, and a failed lookup is only retried after a while
+        self._username_retry = time.monotonic() + USERNAME_RETRY
+        try:
+            me = await self.get_me()
         except Exception:
-            traceback.print_exc()
+            logging.exception("getMe failed")
+            return
+        if me is None:
+            logging.error("getMe failed, the bot's username is unknown")
+        else:
+            self.username = me.username
+
+    async def _run_handler(self, func, value, update: dict):
+        # never raises, so that one handler can't affect the others
+        try:
+            if self.metrics is not None:
+                call = self._timed(func, value)
+            else:
+                call = func(value)
+            if self.handler_timeout is not None:
+                await asyncio.wait_for(call, self.handler_timeout)
+            else:
+                await call
+        except Exception as e:
+            await self._report(e, update, func)
+
+    async def _report(self, error: Exception, update: dict, handler):
+        if self.metrics is not None:
+            self.metrics.inc(
+                "handler_timeouts"
+                if isinstance(error, asyncio.TimeoutError)
+                else "handler_failures"
+            )
+        if self.on_error is not None:
+            try:
+                result = self.on_error(error, update, handler)
+                if inspect.isawaitable(result):
+                    await result
+                return
+            except Exception:
+                logging.exception("on_error failed")
+        if handler is None:
+            logging.error(
+                "Update %s failed", update.get("update_id"), exc_info=error
+            )
+        else:
+            logging.error(
+                "Handler %s failed on update %s",
+                getattr(handler, "__qualname__", repr(handler)),
+                update.get("update_id"),
+                exc_info=error,
+            )
+
+    async def _timed(self, func, value):
+        with self.metrics.span(
+            "handler", handler=getattr(func, "__qualname__", repr(func))
+        ):
+            return await func(value)
 
     onMessageOnly = []
     onMessage = []
@@ -226,35 +1026,270 @@ class Bot:
     onChatJoinRequest = []
     onRaw = []  # just in case
 
-    async def start(self):
+    async def start(self, run_workers: bool = True):
+        """
+        With run_workers=False updates are only received into
+        self.queue and something else has to handle them.
+        """
+        await self.open()
+        if self.username is None and any(
+            router.commands for _, router in self._dispatch.values()
+        ):
+            await self._load_username()
         await self.poller.start()
-        await self.worker.start()
+        if run_workers:
+            await self.worker.start()
+
+    async def drain(self, timeout: Union[float, None] = None) -> bool:
+        """
+        Waits until every received update is handled and background
+        handlers are done. False if `timeout` ran out first.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while (
+            self.tracker.pending
+            or not self.queue.empty()
+            or self.worker.pending()
+            or self.background_tasks
+        ):
+            if deadline is not None and loop.time() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
 
-    def activate(self):
-        loop = asyncio.get_event_loop()
-        loop.create_task(self.start())
+    async def stop(self, timeout: Union[float, None] = 30) -> bool:
+        """
+        Stops receiving updates, gives the received ones `timeout`
+        seconds to be handled (the rest are cancelled, and not
+        confirmed to Telegram, so they come again after a restart),
+        sends what is queued or held back (waiting up to `timeout`
+        again for the pipeline), saves and confirms the offset and
+        closes the sessions. Returns whether everything was handled.
+        """
+        polling = bool(self.poller.tasks)
+        await self.poller.stop()
         try:
-            loop.run_forever()
-        except Exception:  # just any
-            loop.stop()
+            await self.stop_webhook()
+        except Exception:
+            logging.exception("Stopping the webhook failed")
+        drained = await self.drain(timeout)
+        offset = self.tracker.watermark()
+        if self.poller.unqueued is not None and offset is not None:
+            offset = min(offset, self.poller.unqueued)
+        await self.worker.stop()
+        await cancel_tasks(self.background_tasks)
+        if not await self.pipeline.flush(timeout):
+            drained = False
+        await self.pipeline.stop()
+        if self.coalescer is not None:
+            if not await self.coalescer.flush(timeout):
+                drained = False
+        if polling and offset is not None:
+            try:
+                await self.poller.save_offset(offset)
+                await self.poller.ack(offset)
+            except Exception:
+                logging.exception("Confirming the offset failed")
+        await self.close()
+        return drained
 
-    async def make_request(self, method, data):
-        async with self.session.post(
-            self.api_url + self.token + "/" + method, data=data
-        ) as post:
-            a = await post.json()
+    async def _run_until_signal(self, timeout: Union[float, None]):
+        try:
+            await wait_for_signal()
+        finally:
+            await self.stop(timeout)
+
+    def activate(self, drain_timeout: Union[float, None] = 30):
+        """
+        Runs the bot until SIGINT or SIGTERM, then stops it cleanly.
+        """
+
+        async def main():
+            await self.start()
+            await self._run_until_signal(drain_timeout)
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+
+    async def start_webhook(
+        self, url: str, run_workers: bool = True, **kwargs
+    ):
+        """
+        Same as start, but updates are pushed by Telegram
+        to `url` instead of being polled. Extra arguments
+        go to WebhookServer (host, port, path, secret_token...).
+        """
+        await self.open()
+        self.webhook = WebhookServer(
+            self.token,
+            self.queue,
+            self.session,
+            url,
+            api_url=self._raw_api_url,
+            skip_updates=self.skip_updates,
+            allowed_updates=self.allowed_updates,
+            tracker=self.tracker,
+            **kwargs,
+        )
+        await self.webhook.start()
+        if run_workers:
+            await self.worker.start()
+
+    async def stop_webhook(self):
+        if self.webhook is not None:
+            webhook, self.webhook = self.webhook, None
+            await webhook.stop()
+
+    def activate_webhook(
+        self, url: str, drain_timeout: Union[float, None] = 30, **kwargs
+    ):
+        async def main():
+            await self.start_webhook(url, **kwargs)
+            await self._run_until_signal(drain_timeout)
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+
+    async def make_request(
+        self,
+        method,
+        data,
+        chat_id: Union[int, str, None] = None,
+        limited: bool = False,
+        parse: bool = True,
+    ):
+        """
+        `limited` requests wait for the rate limiter first,
+        `chat_id` is the chat they are sent to, if any.
+        With parse=False a successful response isn't decoded
+        and {"ok": True} is returned.
+        """
+        if self.session is None:
+            await self.open()
+        while True:
+            if limited and self.limiter is not None:
+                await self.limiter.acquire(chat_id)
+            if isinstance(data, dict):
+                body = {
+                    k: json_codec.form_value(v, k)
+                    for k, v in data.items()
+                    if v is not None
+                }
+            elif callable(data) and not isinstance(data, aiohttp.FormData):
+                body = data()  # builds a fresh body for every attempt
+            else:
+                body = data
+            with (
+                self.metrics.span("api_request", method=method)
+                if self.metrics is not None
+                else nullcontext()
+            ):
+                async with self.session.post(
+                    self.api_url + self.token + "/" + method, data=body
+                ) as post:
+                    # read either way, for the connection to be reused
+                    raw = await post.read()
+            if not parse and post.status == 200:
+                return {"ok": True}
+            a = json_codec.loads(raw)
+            if a["ok"] is False and self.metrics is not None:
+                self.metrics.inc(
+                    "api_errors", method=method, code=a.get("error_code")
+                )
             if (
                 a["ok"] is False
                 and "parameters" in a
                 and "retry_after" in a["parameters"]
             ):
-                await asyncio.sleep(a["parameters"]["retry_after"] + 1)
+                retry_after = a["parameters"]["retry_after"]
                 logging.debug("TOO MANY REQUESTS CATCHED")
-                return await self.make_request(method, data)
+                if self.metrics is not None:
+                    self.metrics.inc("api_retry_after", method=method)
+                if limited and self.limiter is not None:
+                    # only this chat waits, the rest keep going
+                    self.limiter.pause(chat_id, retry_after)
+                else:
+                    await asyncio.sleep(retry_after + 1)
+                continue
             logging.debug([data, a])
             return a
 
-    async def send_document(  # noqa: C901
+    async def _send_coalesced(self, method, payload, chat_id):
+        return await self.make_request(
+            method,
+            payload,
+            chat_id=chat_id,
+            limited=method != "answerCallbackQuery",
+        )
+
+    async def _send_pipelined(self, method, payload, chat_id, parse):
+        return await self.make_request(
+            method, payload, chat_id=chat_id, limited=True, parse=parse
+        )
+
+    def submit(
+        self,
+        method: str,
+        payload: dict,
+        chat_id: Union[int, str, None] = None,
+        typeof: Union[str, None] = None,
+        parse: bool = True,
+    ) -> Union[PendingResult, None]:
+        """
+        Queues a request to `chat_id` in the outgoing pipeline and
+        returns right away. Awaiting the PendingResult gives the
+        result (converted to `typeof`), or None if Telegram answered
+        with an error; a network error is raised from it.
+        With parse=False it is fire and forget, None is returned
+        and the response is only looked at for errors.
+
+        Pipelined requests to a chat keep their order, but
+        requests made with await in the meantime can overtake them.
+        """
+        return self.pipeline.submit(method, payload, chat_id, typeof, parse)
+
+    async def broadcast(
+        self,
+        chat_ids: Union[Iterable, AsyncIterable],
+        text: Union[str, None] = None,
+        method: str = "sendMessage",
+        concurrency: int = 20,
+        retries: int = 3,
+        checkpoint: Union[str, None] = None,
+        progress: Union[Callable[[BroadcastStats], Any], None] = None,
+        progress_interval: float = 5.0,
+        **params,
+    ) -> BroadcastStats:
+        """
+        Sends `text` (or any `method` with `params`) to every chat
+        in `chat_ids`, see Broadcast for the details.
+        """
+        if text is not None:
+            params["text"] = text
+        if method == "sendMessage" and "entities" not in params:
+            params.setdefault("parse_mode", "HTML")
+        for key in ("reply_markup", "entities", "caption_entities"):
+            # serialized once for all chats
+            if key in params and not isinstance(params[key], str):
+                params[key] = json_codec.dumps(params[key])
+        return await Broadcast(
+            self,
+            chat_ids,
+            method=method,
+            params=params,
+            concurrency=concurrency,
+            retries=retries,
+            checkpoint=checkpoint,
+            progress=progress,
+            progress_interval=progress_interval,
+        ).run()
+
+    async def send_document(
         self,
         chat_id: Union[str, int],
         document: Any,
@@ -268,50 +1303,213 @@ class Bot:
         protect_content: Union[bool, None] = None,
         reply_to_message_id: Union[int, None] = None,
         allow_sending_without_reply: Union[bool, None] = None,
-        reply_markup: Union[str, None] = None,
+        reply_markup: Union[dict, str, None] = None,
     ):
-        data = aiohttp.FormData(quote_fields=False)
-        if chat_id:
-            data.add_field("chat_id", chat_id and str(chat_id))
-        if message_thread_id:
-            data.add_field("message_thread_id", message_thread_id)
-        if caption:
-            data.add_field("caption", chat_id)
-        if caption_entities:
-            data.add_field("caption_entities", json.dumps(caption_entities))
-        if disable_content_type_detection:
-            data.add_field(
-                "disable_content_type_detection",
-                json.dumps(disable_content_type_detection),
-            )
-        if disable_notification:
-            data.add_field(
-                "disable_notification", json.dumps(disable_notification)
-            )
-        if disable_content_type_detection:
-            data.add_field(
-                "disable_content_type_detection",
-                json.dumps(disable_content_type_detection),
-            )
-        if protect_content:
-            data.add_field("protect_content", json.dumps(protect_content))
-        if reply_to_message_id:
-            data.add_field("reply_to_message_id", str(reply_to_message_id))
-        if allow_sending_without_reply:
-            data.add_field(
-                "allow_sending_without_reply",
-                json.dumps(allow_sending_without_reply),
+        """
+        `document` (and `thumb`) can be a file_id or URL, or anything
+        InputFile takes: a path, a file object, bytes or an iterator
+        of chunks. A file sent before is sent by its file_id.
+        """
+        fields = {
+            "chat_id": chat_id,
+            "message_thread_id": message_thread_id,
+            "caption": caption,
+            "parse_mode": parse_mode or "HTML",
+            "caption_entities": caption_entities,
+            "disable_content_type_detection": disable_content_type_detection,
+            "disable_notification": disable_notification,
+            "protect_content": protect_content,
+            "reply_to_message_id": reply_to_message_id,
+            "allow_sending_without_reply": allow_sending_without_reply,
+            "reply_markup": reply_markup,
+        }
+        return await self._send_file(
+            "sendDocument", "document", document, fields, chat_id, thumb
+        )
+
+    async def _send_file(
+        self,
+        method: str,
+        field: str,
+        file: Any,
+        fields: dict,
+        chat_id: Union[int, str],
+        thumb: Any = None,
+    ):
+        file = as_input_file(file)
+        thumb = as_input_file(thumb)
+        key = file.cache_key if isinstance(file, InputFile) else None
+        file_id = self.file_ids.get(key)
+
+        def build():
+            # called for every attempt, files can't be sent twice
+            data = aiohttp.FormData(quote_fields=False)
+            for k, v in fields.items():
+                if v is not None:
+                    data.add_field(k, json_codec.form_value(v, k))
+            if file_id is not None:
+                data.add_field(field, file_id)
+            elif isinstance(file, InputFile):
+                data.add_field(
+                    field,
+                    file.payload(),
+                    filename=file.filename,
+                    content_type=file.content_type,
+                )
+            else:
+                data.add_field(field, file)
+            if isinstance(thumb, InputFile):
+                data.add_field(
+                    "thumbnail",
+                    thumb.payload(),
+                    filename=thumb.filename,
+                    content_type=thumb.content_type,
+                )
+                data.add_field("thumb", "attach://thumbnail")
+            elif thumb is not None:
+                data.add_field("thumb", thumb)
+            return data
+
+        result = await self.make_request(
+            method, build, chat_id=chat_id, limited=True
+        )
+        if (
+            file_id is not None
+            and not result["ok"]
+            and result.get("error_code") == 400
+        ):
+            # the file_id doesn't work anymore, upload the file itself
+            self.file_ids.discard(key)
+            file_id = None
+            result = await self.make_request(
+                method, build, chat_id=chat_id, limited=True
             )
-        if reply_markup:
-            data.add_field("reply_markup", json.dumps(reply_markup))
-        data.add_field("parse_mode", parse_mode or "HTML")
-        data.add_field("document", document)
-        if thumb:
-            data.add_field("thumblike", thumb)
-            data.add_field(
-                "thumb", "attach://thumblike"
-            )  # I haven't tested it yet.
-        return await self.make_request("sendDocument", data)
+        if key is not None and result["ok"]:
+            sent = result["result"].get(field)
+            if isinstance(sent, list):  # photo sizes, the largest is last
+                sent = sent[-1] if sent else None
+            if isinstance(sent, dict) and "file_id" in sent:
+                self.file_ids.put(key, sent["file_id"])
+        return result
+
+    async def get_file(self, file_id: str):
+        return await self.make_request("getFile", {"file_id": file_id})
+
+    # results of the lookups below are cached and shared
+    # between callers, so they shouldn't be modified
+    async def _cached(self, method: str, data: dict, *key) -> dict:
+        if self.cache is None:
+            return await self.make_request(method, data)
+        return await self.cache.get(
+            (method,) + key, partial(self.make_request, method, data)
+        )
+
+    async def get_me(self) -> Union[User, None]:
+        result = await self._cached("getMe", {})
+        if result["ok"]:
+            return convert_dict(result["result"], "user")
+        return None
+
+    async def get_chat(self, chat_id: Union[int, str]) -> Union[Chat, None]:
+        result = await self._cached("getChat", {"chat_id": chat_id}, chat_id)
+        if result["ok"]:
+            return convert_dict(result["result"], "chat")
+        return None
+
+    def _watch_members(self):
+        # a busy group sends lots of member updates, so they are only
+        # asked for once there is something cached for them to refresh
+        if self.cache is None or self._member_updates:
+            return
+        self._member_updates = True
+        if self.webhook is not None:
+            # polling picks the new list up with its next request
+            task = asyncio.create_task(self._refresh_webhook())
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    async def _refresh_webhook(self):
+        try:
+            await self.webhook.set_webhook(drop_pending=False)
+        except Exception:
+            logging.exception("Updating allowed_updates failed")
+
+    async def get_chat_member(
+        self, chat_id: Union[int, str], user_id: int
+    ) -> Union[dict, None]:
+        self._watch_members()
+        result = await self._cached(
+            "getChatMember",
+            {"chat_id": chat_id, "user_id": user_id},
+            chat_id,
+            user_id,
+        )
+        if result["ok"]:
+            return result["result"]
+        return None
+
+    async def get_chat_administrators(
+        self, chat_id: Union[int, str]
+    ) -> Union[List[dict], None]:
+        self._watch_members()
+        result = await self._cached(
+            "getChatAdministrators", {"chat_id": chat_id}, chat_id
+        )
+        if result["ok"]:
+            return result["result"]
+        return None
+
+    async def iter_file(self, file_path: str, chunk_size: int = 65536):
+        """
+        Chunks of a file from getFile's file_path as they arrive.
+        """
+        if self.session is None:
+            await self.open()
+        async with self.session.get(
+            self.file_url + self.token + "/" + file_path
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def download_file(
+        self,
+        destination: Any,
+        file_id: Union[str, None] = None,
+        file_path: Union[str, None] = None,
+        chunk_size: int = 65536,
+    ) -> int:
+        """
+        Streams a file to `destination`: a path, a binary file object
+        or a (async) function called with every chunk. Only one chunk
+        is held in memory at a time. Returns the size of the file.
+        """
+        if file_path is None:
+            result = await self.get_file(file_id)
+            if not result["ok"]:
+                raise RuntimeError("getFile failed: %s" % result)
+            file_path = result["result"]["file_path"]
+        loop = asyncio.get_running_loop()
+        if isinstance(destination, (str, os.PathLike)):
+            f = await loop.run_in_executor(None, open, destination, "wb")
+            write = partial(loop.run_in_executor, None, f.write)
+        elif hasattr(destination, "write"):
+            f = None
+            write = partial(loop.run_in_executor, None, destination.write)
+        else:
+            f = None
+            write = destination
+        size = 0
+        try:
+            async for chunk in self.iter_file(file_path, chunk_size):
+                written = write(chunk)
+                if inspect.isawaitable(written):
+                    await written
+                size += len(chunk)
+        finally:
+            if f is not None:
+                await loop.run_in_executor(None, f.close)
+        return size
 
     async def send_message(  # noqa: C901
         self,
@@ -325,8 +1523,15 @@ class Bot:
         protect_content: Union[bool, None] = None,
         reply_to_message_id: Union[int, None] = None,
         allow_sending_without_reply: Union[bool, None] = None,
-        reply_markup: Union[dict, None] = None,
+        reply_markup: Union[dict, str, None] = None,
+        wait: bool = True,
+        forget: bool = False,
     ):
+        """
+        wait=False returns a PendingResult (see submit) without
+        waiting for the request, forget=True returns None and
+        doesn't look at the response beyond errors.
+        """
         payload = {"chat_id": chat_id, "text": text}
         if message_thread_id is not None:
             payload["message_thread_id"] = message_thread_id
@@ -340,7 +1545,7 @@ class Bot:
         if disable_notification is not None:
             payload["disable_notification"] = disable_notification
         if entities is not None:
-            payload["entities"] = json.dumps(entities)
+            payload["entities"] = entities
         if protect_content is not None:
             payload["protect_content"] = protect_content
         if reply_to_message_id is not None:
@@ -350,9 +1555,14 @@ class Bot:
                 "allow_sending_without_reply"
             ] = allow_sending_without_reply
         if reply_markup is not None:
-            payload["reply_markup"] = json.dumps(reply_markup)
-        print(payload)
-        result = await self.make_request("sendMessage", payload)
+            payload["reply_markup"] = reply_markup
+        if forget or not wait:
+            return self.submit(
+                "sendMessage", payload, chat_id, "message", parse=not forget
+            )
+        result = await self.make_request(
+            "sendMessage", payload, chat_id=chat_id, limited=True
+        )
         if result["ok"]:
             return convert_dict(result["result"], "message")
         else:
@@ -391,7 +1601,13 @@ class Bot:
             payload["url"] = url
         if cache_time is not None:
             payload["cache_time"] = cache_time
-        await self.make_request("answerCallbackQuery", payload)
+        if self.coalescer is not None:
+            return await self.coalescer.submit(
+                ("answerCallbackQuery", callback_query_id),
+                "answerCallbackQuery",
+                payload,
+            )
+        return await self.make_request("answerCallbackQuery", payload)
 
     async def edit_message_text(
         self,
@@ -402,7 +1618,7 @@ class Bot:
         parse_mode: Union[str, None] = "HTML",
         entities: Union[List, None] = None,
         disable_web_page_preview: Union[bool, None] = None,
-        reply_markup: Union[dict, None] = None,
+        reply_markup: Union[dict, str, None] = None,
     ):
         payload = {"text": text}
         if chat_id is not None:
@@ -418,5 +1634,15 @@ class Bot:
         if disable_web_page_preview is not None:
             payload["disable_web_page_preview"] = disable_web_page_preview
         if reply_markup is not None:
-            payload["reply_markup"] = json.dumps(reply_markup)
-        await self.make_request("editMessageText", payload)
+            payload["reply_markup"] = reply_markup
+        if self.coalescer is not None:
+            # an edit still waiting to be sent is replaced by this one
+            return await self.coalescer.submit(
+                ("editMessageText", chat_id, message_id, inline_message_id),
+                "editMessageText",
+                payload,
+                chat_id,
+            )
+        return await self.make_request(
+            "editMessageText", payload, chat_id=chat_id, limited=True
+        )
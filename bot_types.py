@@ -1,4 +1,13 @@
-from typing import Union
+from typing import List, Union
+
+from .entities import (
+    get_commands,
+    get_mentions,
+    get_urls,
+    parse_entities,
+    to_html,
+    to_markdown,
+)
 
 
 class Handlers:
@@ -16,196 +25,486 @@ class Handlers:
     onPollAnswer = "onPollAnswer"
     onChatMemberUpdated = "onChatMemberUpdated"
     onChatJoinRequest = "onChatJoinRequest"
+    onRaw = "onRaw"
+
+
+# update types every handler list is fed with,
+# used to build allowed_updates for getUpdates/setWebhook
+ALL_UPDATES = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "inline_query",
+    "chosen_inline_result",
+    "callback_query",
+    "shipping_query",
+    "pre_checkout_query",
+    "poll",
+    "poll_answer",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+)
+
+# convert_dict type every update type is converted to, None means raw dict
+UPDATE_TYPES = {
+    "message": "message",
+    "edited_message": "message",
+    "channel_post": "message",
+    "edited_channel_post": "message",
+    "inline_query": None,
+    "chosen_inline_result": None,
+    "callback_query": "callback_query",
+    "shipping_query": None,
+    "pre_checkout_query": None,
+    "poll": None,
+    "poll_answer": None,
+    "my_chat_member": None,
+    "chat_member": None,
+    "chat_join_request": None,
+}
+
+HANDLER_UPDATES = {
+    Handlers.onMessage: (
+        "message",
+        "edited_message",
+        "channel_post",
+        "edited_channel_post",
+    ),
+    Handlers.onMessageOnly: ("message",),
+    Handlers.onEditedMessage: ("edited_message",),
+    Handlers.onChannelPost: ("channel_post",),
+    Handlers.onEditedChannelPost: ("edited_channel_post",),
+    Handlers.onInlineQuery: ("inline_query",),
+    Handlers.onChosenInlineResult: ("chosen_inline_result",),
+    Handlers.onCallbackQuery: ("callback_query",),
+    Handlers.onShippingQuery: ("shipping_query",),
+    Handlers.onPreCheckoutQuery: ("pre_checkout_query",),
+    Handlers.onPoll: ("poll",),
+    Handlers.onPollAnswer: ("poll_answer",),
+    Handlers.onChatMemberUpdated: ("my_chat_member", "chat_member"),
+    Handlers.onChatJoinRequest: ("chat_join_request",),
+    Handlers.onRaw: ALL_UPDATES,
+}
+
+
+def get_update_key(update: dict):
+    """
+    Chat (or user) the update belongs to. Updates
+    with the same key should be handled in order.
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        if "chat" in value:
+            return value["chat"]["id"]
+        if "chat" in value.get("message", ()):  # callback_query
+            return value["message"]["chat"]["id"]
+        if "from" in value:
+            return value["from"]["id"]
+        if "user" in value:  # poll_answer
+            return value["user"]["id"]
+        break
+    # nothing to order by (polls), any worker will do
+    return update.get("update_id")
 
 
 # TYPES OF TELEGRAM OBJECTS
+#
+# Objects are thin views over the dict received from the API:
+# plain fields are read from it directly, nested objects are
+# decoded on first access and cached in a slot of their own.
 
 
-def convert_dict(d: dict, typeof: str):
-    if typeof == "message":
-        return Message(
-            message_id=d["message_id"],
-            date=d["date"],
-            chat=convert_dict(d["chat"], "chat"),
-            message_thread_id=d["message_thread_id"]
-            if "message_thread_id" in d
-            else None,
-            from_user=convert_dict(d["from"], "user") if "from" in d else None,
-            sender_chat=convert_dict(d["sender_chat"], "chat")
-            if "sender_chat" in d
-            else None,
-            forward_from=convert_dict(d["forward_from"], "user")
-            if "forward_from" in d
-            else None,
-            forward_from_chat=d["forward_from_chat"]
-            if "forward_from_chat" in d
-            else None,
-            forward_from_message_id=d["forward_from_message_id"]
-            if "forward_from_message_id" in d
-            else None,
-            reply_to_message=d["reply_to_message"]
-            if "reply_to_message" in d
-            else None,
-            via_bot=convert_dict(d["via_bot"], "user")
-            if "via_bot" in d
-            else None,
-            text=d["text"] if "text" in d else None,
-            reply_markup=d["reply_markup"] if "reply_markup" in d else None,
-            entities=d["entities"] if "entities" in d else None,
-        )
-    elif typeof == "chat":
-        return Chat(
-            id=d["id"],
-            typeof=d["type"],
-            title=d["title"] if "title" in d else None,
-            username=d["username"] if "username" in d else None,
-            first_name=d["first_name"] if "first_name" in d else None,
-            last_name=d["last_name"] if "last_name" in d else None,
-        )
-    elif typeof == "callback_query":
-        return CallbackQuery(
-            id=d["id"],
-            from_user=convert_dict(d["from"], "user"),  # class User
-            chat_instance=d["chat_instance"],
-            message=convert_dict(d["message"], "message")
-            if "message" in d
-            else None,
-            inline_message_id=d["inline_message_id"]
-            if "inline_message_id" in d
-            else None,
-            data=d["data"] if "data" in d else None,
-            game_short_name=d["game_short_name"]
-            if "game_short_name" in d
-            else None,
-        )
-    elif typeof == "user":
-        return User(
-            id=d["id"],
-            is_bot=d["is_bot"],
-            first_name=d["first_name"] if "first_name" in d else None,
-            last_name=d["last_name"] if "last_name" in d else None,
-            username=d["username"] if "username" in d else None,
-            language_code=d["language_code"] if "language_code" in d else None,
-            is_premium=d["is_premium"] if "is_premium" in d else None,
-            added_to_attachment_menu=d["added_to_attachment_menu"]
-            if "added_to_attachment_menu" in d
-            else None,
-            can_join_groups=d["can_join_groups"]
-            if "can_join_groups" in d
-            else None,
-            can_read_all_group_messages=d["can_read_all_group_messages"]
-            if "can_read_all_group_messages" in d
-            else None,
-            supports_inline_queries=d["supports_inline_queries"]
-            if "supports_inline_queries" in d
-            else None,
+class Field:
+    __slots__ = ("key", "typeof", "many", "slot")
+
+    def __init__(
+        self,
+        key: Union[str, None] = None,
+        typeof: Union[str, None] = None,
+        many: bool = False,
+    ):
+        self.key = key
+        self.typeof = typeof  # key of TYPES, None for plain values
+        self.many = many
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        if self.key is None:
+            self.key = name
+        if self.typeof is not None:
+            self.slot = owner.__dict__["_" + name]
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        if self.slot is None:
+            return obj._raw.get(self.key)
+        try:
+            return self.slot.__get__(obj, owner)
+        except AttributeError:  # not decoded yet
+            pass
+        value = obj._raw.get(self.key)
+        if value is not None:
+            cls = TYPES[self.typeof]
+            value = [cls(i) for i in value] if self.many else cls(value)
+        self.slot.__set__(obj, value)
+        return value
+
+
+class _TypeMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        fields = [k for k, v in namespace.items() if isinstance(v, Field)]
+        namespace["__slots__"] = tuple(namespace.get("__slots__", ())) + (
+            tuple("_" + k for k in fields if namespace[k].typeof is not None)
         )
-    return d
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls._fields = getattr(cls, "_fields", ()) + tuple(fields)
+        return cls
+
 
+class BaseType(metaclass=_TypeMeta):
+    __slots__ = ("_raw",)
+
+    def __init__(self, raw: dict):
+        self._raw = raw
+
+    def to_dict(self) -> dict:
+        return self._raw
 
-class BaseType:
     def __repr__(self):
-        fields = tuple("{}={}".format(k, v) for k, v in self.__dict__.items())
+        fields = tuple(
+            "{}={}".format(k, getattr(self, k)) for k in self._fields
+        )
         return self.__class__.__name__ + str(tuple(sorted(fields))).replace(
             "'", ""
         )
 
 
 class User(BaseType):
-    def __init__(
-        self,
-        id: int,
-        is_bot: bool,
-        first_name: str,
-        last_name: Union[str, None] = None,
-        username: Union[str, None] = None,
-        language_code: Union[str, None] = None,
-        is_premium: Union[bool, None] = None,
-        added_to_attachment_menu: Union[bool, None] = None,
-        can_join_groups: Union[bool, None] = None,
-        can_read_all_group_messages: Union[bool, None] = None,
-        supports_inline_queries: Union[bool, None] = None,
-    ):
-        self.id = id
-        self.is_bot = is_bot
-        self.first_name = first_name
-        self.last_name = last_name
-        self.username = username
-        self.language_code = language_code
-        self.is_premium = is_premium
-        self.added_to_attachment_menu = added_to_attachment_menu
-        self.can_join_groups = can_join_groups
-        self.can_read_all_group_messages = can_read_all_group_messages
-        self.supports_inline_queries = supports_inline_queries
+    id = Field()
+    is_bot = Field()
+    first_name = Field()
+    last_name = Field()
+    username = Field()
+    language_code = Field()
+    is_premium = Field()
+    added_to_attachment_menu = Field()
+    can_join_groups = Field()
+    can_read_all_group_messages = Field()
+    supports_inline_queries = Field()
 
 
 class Chat(BaseType):
-    def __init__(
-        self,
-        id: int,
-        typeof: str,
-        title: Union[str, None] = None,
-        username: Union[str, None] = None,
-        first_name: Union[str, None] = None,
-        last_name: Union[str, None] = None,
-    ):
-        self.id = id
-        self.type = (typeof,)
-        self.title = title
-        self.username = username
-        self.first_name = first_name
-        self.last_name = last_name
+    id = Field()
+    type = Field()
+    title = Field()
+    username = Field()
+    first_name = Field()
+    last_name = Field()
+
+
+class MessageEntity(BaseType):
+    type = Field()
+    offset = Field()
+    length = Field()
+    url = Field()
+    user = Field(typeof="user")
+    language = Field()
+    custom_emoji_id = Field()
+
+
+class PhotoSize(BaseType):
+    file_id = Field()
+    file_unique_id = Field()
+    width = Field()
+    height = Field()
+    file_size = Field()
+
+
+class Document(BaseType):
+    file_id = Field()
+    file_unique_id = Field()
+    thumb = Field(typeof="photo_size")
+    file_name = Field()
+    mime_type = Field()
+    file_size = Field()
+
+
+class Audio(Document):
+    duration = Field()
+    performer = Field()
+    title = Field()
+
+
+class Video(Document):
+    width = Field()
+    height = Field()
+    duration = Field()
+
+
+class Animation(Video):
+    pass
+
+
+class VideoNote(BaseType):
+    file_id = Field()
+    file_unique_id = Field()
+    length = Field()
+    duration = Field()
+    thumb = Field(typeof="photo_size")
+    file_size = Field()
+
+
+class Voice(BaseType):
+    file_id = Field()
+    file_unique_id = Field()
+    duration = Field()
+    mime_type = Field()
+    file_size = Field()
+
+
+class Sticker(BaseType):
+    file_id = Field()
+    file_unique_id = Field()
+    type = Field()
+    width = Field()
+    height = Field()
+    is_animated = Field()
+    is_video = Field()
+    thumb = Field(typeof="photo_size")
+    emoji = Field()
+    set_name = Field()
+    custom_emoji_id = Field()
+    file_size = Field()
+
+
+class Contact(BaseType):
+    phone_number = Field()
+    first_name = Field()
+    last_name = Field()
+    user_id = Field()
+    vcard = Field()
+
+
+class Location(BaseType):
+    longitude = Field()
+    latitude = Field()
+    horizontal_accuracy = Field()
+    live_period = Field()
+    heading = Field()
+    proximity_alert_radius = Field()
+
+
+class Venue(BaseType):
+    location = Field(typeof="location")
+    title = Field()
+    address = Field()
+    foursquare_id = Field()
+    foursquare_type = Field()
+    google_place_id = Field()
+    google_place_type = Field()
+
+
+class Dice(BaseType):
+    emoji = Field()
+    value = Field()
+
+
+class PollOption(BaseType):
+    text = Field()
+    voter_count = Field()
+
+
+class Poll(BaseType):
+    id = Field()
+    question = Field()
+    options = Field(typeof="poll_option", many=True)
+    total_voter_count = Field()
+    is_closed = Field()
+    is_anonymous = Field()
+    type = Field()
+    allows_multiple_answers = Field()
+    correct_option_id = Field()
+    explanation = Field()
+    explanation_entities = Field(typeof="message_entity", many=True)
+    open_period = Field()
+    close_date = Field()
+
+
+# message fields that tell what kind of message it is
+CONTENT_TYPES = (
+    "text",
+    "photo",
+    "document",
+    "sticker",
+    "video",
+    "animation",
+    "audio",
+    "voice",
+    "video_note",
+    "contact",
+    "location",
+    "venue",
+    "poll",
+    "dice",
+    "game",
+    "invoice",
+    "successful_payment",
+    "new_chat_members",
+    "left_chat_member",
+    "new_chat_title",
+    "new_chat_photo",
+    "delete_chat_photo",
+    "pinned_message",
+)
 
 
 class Message(BaseType):
-    def __init__(
-        self,
-        message_id: int,
-        date: int,
-        chat: Chat,
-        message_thread_id: Union[int, None] = None,
-        from_user: Union[User, None] = None,
-        sender_chat: Union[Chat, None] = None,
-        forward_from: Union[User, None] = None,
-        forward_from_chat: Union[dict, None] = None,
-        forward_from_message_id: Union[int, None] = None,
-        reply_to_message: Union[dict, None] = None,
-        via_bot: Union[dict, None] = None,
-        text: Union[str, None] = None,
-        reply_markup: Union[dict, None] = None,
-        entities: Union[list, None] = None,
-    ):
-        self.message_id = message_id
-        self.date = date
-        self.chat = chat
-        self.message_thread_id = message_thread_id
-        self.from_user = from_user
-        self.sender_chat = sender_chat
-        self.forward_from = forward_from
-        self.forward_from_chat = forward_from_chat
-        self.forward_from_message_id = forward_from_message_id
-        self.reply_to_message = reply_to_message
-        self.via_bot = via_bot
-        self.text = text
-        self.reply_markup = reply_markup
-        self.entities = entities
+    __slots__ = ("_spans",)
+
+    message_id = Field()
+    date = Field()
+    chat = Field(typeof="chat")
+    message_thread_id = Field()
+    from_user = Field("from", "user")
+    sender_chat = Field(typeof="chat")
+    forward_from = Field(typeof="user")
+    forward_from_chat = Field(typeof="chat")
+    forward_from_message_id = Field()
+    forward_signature = Field()
+    forward_sender_name = Field()
+    forward_date = Field()
+    is_topic_message = Field()
+    is_automatic_forward = Field()
+    reply_to_message = Field(typeof="message")
+    via_bot = Field(typeof="user")
+    edit_date = Field()
+    has_protected_content = Field()
+    media_group_id = Field()
+    author_signature = Field()
+    text = Field()
+    entities = Field(typeof="message_entity", many=True)
+    animation = Field(typeof="animation")
+    audio = Field(typeof="audio")
+    document = Field(typeof="document")
+    photo = Field(typeof="photo_size", many=True)
+    sticker = Field(typeof="sticker")
+    video = Field(typeof="video")
+    video_note = Field(typeof="video_note")
+    voice = Field(typeof="voice")
+    caption = Field()
+    caption_entities = Field(typeof="message_entity", many=True)
+    has_media_spoiler = Field()
+    contact = Field(typeof="contact")
+    dice = Field(typeof="dice")
+    game = Field()
+    poll = Field(typeof="poll")
+    venue = Field(typeof="venue")
+    location = Field(typeof="location")
+    new_chat_members = Field(typeof="user", many=True)
+    left_chat_member = Field(typeof="user")
+    new_chat_title = Field()
+    new_chat_photo = Field(typeof="photo_size", many=True)
+    delete_chat_photo = Field()
+    group_chat_created = Field()
+    migrate_to_chat_id = Field()
+    migrate_from_chat_id = Field()
+    pinned_message = Field(typeof="message")
+    invoice = Field()
+    successful_payment = Field()
+    reply_markup = Field()
+
+    @property
+    def content_type(self) -> Union[str, None]:
+        raw = self._raw
+        for i in CONTENT_TYPES:
+            if i in raw:
+                return i
+        return None
+
+    @property
+    def spans(self) -> list:
+        """
+        Entities of the text (or caption) as entities.Span with
+        string indices, parsed once and shared by all handlers.
+        """
+        try:
+            return self._spans
+        except AttributeError:
+            pass
+        raw = self._raw
+        if "text" in raw:
+            spans = parse_entities(raw["text"], raw.get("entities"))
+        else:
+            spans = parse_entities(
+                raw.get("caption"), raw.get("caption_entities")
+            )
+        self._spans = spans
+        return spans
+
+    @property
+    def commands(self) -> List[str]:
+        return get_commands(self.spans)
+
+    @property
+    def mentions(self) -> list:
+        return get_mentions(self.spans)
+
+    @property
+    def urls(self) -> List[str]:
+        return get_urls(self.spans)
+
+    @property
+    def html_text(self) -> str:
+        """
+        Text (or caption) with its formatting, ready to be sent
+        again with parse_mode="HTML".
+        """
+        return to_html(self.text or self.caption, self.spans)
+
+    @property
+    def markdown_text(self) -> str:
+        return to_markdown(self.text or self.caption, self.spans)
 
 
 class CallbackQuery(BaseType):
-    def __init__(
-        self,
-        id: str,
-        from_user: User,  # class User
-        chat_instance: str,
-        message: Union[Message, None] = None,
-        inline_message_id: Union[str, None] = None,
-        data: Union[str, None] = None,
-        game_short_name: Union[str, None] = None,
-    ):
-        self.id = id
-        self.from_user = from_user
-        self.chat_instance = chat_instance
-        self.message = message
-        self.inline_message_id = inline_message_id
-        self.data = data
-        self.game_short_name = game_short_name
+    id = Field()
+    from_user = Field("from", "user")
+    chat_instance = Field()
+    message = Field(typeof="message")
+    inline_message_id = Field()
+    data = Field()
+    game_short_name = Field()
+
+
+TYPES = {
+    "user": User,
+    "chat": Chat,
+    "message_entity": MessageEntity,
+    "photo_size": PhotoSize,
+    "document": Document,
+    "audio": Audio,
+    "video": Video,
+    "animation": Animation,
+    "video_note": VideoNote,
+    "voice": Voice,
+    "sticker": Sticker,
+    "contact": Contact,
+    "location": Location,
+    "venue": Venue,
+    "dice": Dice,
+    "poll_option": PollOption,
+    "poll": Poll,
+    "message": Message,
+    "callback_query": CallbackQuery,
+}
+
+
+def convert_dict(d: dict, typeof: str):
+    cls = TYPES.get(typeof)
+    if cls is None:
+        return d
+    return cls(d)
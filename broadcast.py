@@ -0,0 +1,218 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import (
+    Any,
+    AsyncIterable,
+    Callable,
+    Iterable,
+    List,
+    Union,
+)
+
+import aiohttp
+
+from .lifecycle import cancel_tasks
+
+# descriptions meaning the chat can't be reached anymore
+UNREACHABLE = (
+    "blocked",
+    "deactivated",
+    "chat not found",
+    "kicked",
+    "not a member",
+)
+
+
+class BroadcastStats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.blocked: List[Union[int, str]] = []
+        self.position = 0  # every target before it is done
+        self.resumed = 0  # done by previous runs
+        self.started = time.monotonic()
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + len(self.blocked)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self) -> float:
+        """
+        Targets done per second.
+        """
+        elapsed = self.elapsed
+        return (self.done - self.resumed) / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return (
+            "BroadcastStats(sent={}, failed={}, blocked={}, "
+            "position={}, rate={:.1f}/s)".format(
+                self.sent,
+                self.failed,
+                len(self.blocked),
+                self.position,
+                self.rate,
+            )
+        )
+
+
+class Broadcast:
+    """
+    Sends the same request to many chats with bounded concurrency.
+
+    Targets are read lazily, so `chat_ids` can be a generator
+    or an async iterator over a database cursor. With `checkpoint`
+    set, progress is saved to that file every `progress_interval`
+    seconds and a later run with the same file and targets
+    continues where the previous one stopped.
+    """
+
+    def __init__(
+        self,
+        bot,
+        chat_ids: Union[Iterable, AsyncIterable],
+        method: str = "sendMessage",
+        params: Union[dict, None] = None,
+        concurrency: int = 20,
+        retries: int = 3,
+        checkpoint: Union[str, None] = None,
+        progress: Union[Callable[[BroadcastStats], Any], None] = None,
+        progress_interval: float = 5.0,
+    ):
+        self.bot = bot
+        self.chat_ids = chat_ids
+        self.method = method
+        self.params = params or {}
+        self.concurrency = concurrency
+        self.retries = retries
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stats = BroadcastStats()
+        self._completed = set()
+
+    def _load_checkpoint(self):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.stats.position = state["position"]
+        self.stats.sent = state["sent"]
+        self.stats.failed = state["failed"]
+        self.stats.blocked = state["blocked"]
+        # done out of order, past a target that was still being sent
+        self._completed = set(state.get("completed", ()))
+        self.stats.resumed = self.stats.done
+
+    def _save_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        state = {
+            "position": self.stats.position,
+            "sent": self.stats.sent,
+            "failed": self.stats.failed,
+            "blocked": self.stats.blocked,
+            "completed": sorted(self._completed),
+        }
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
+
+    async def _produce(self, targets: asyncio.Queue):
+        index = 0
+        skip = self.stats.position
+        done = set(self._completed)
+        if hasattr(self.chat_ids, "__aiter__"):
+            async for chat_id in self.chat_ids:
+                if index >= skip and index not in done:
+                    await targets.put((index, chat_id))
+                index += 1
+        else:
+            for chat_id in self.chat_ids:
+                if index >= skip and index not in done:
+                    await targets.put((index, chat_id))
+                index += 1
+        for _ in range(self.concurrency):
+            await targets.put(None)
+
+    async def _send(self, chat_id) -> Union[dict, None]:
+        payload = dict(self.params)
+        payload["chat_id"] = chat_id
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(random.uniform(0.5, 1.0) * 2**attempt)
+            try:
+                res = await self.bot.make_request(
+                    self.method, payload, chat_id=chat_id, limited=True
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                # ValueError: not JSON, e.g. an error page of a proxy
+                continue
+            if res["ok"] or res.get("error_code", 500) < 500:
+                return res
+        return None
+
+    def _finish(self, index: int):
+        self._completed.add(index)
+        while self.stats.position in self._completed:
+            self._completed.remove(self.stats.position)
+            self.stats.position += 1
+
+    async def _worker(self, targets: asyncio.Queue):
+        while True:
+            target = await targets.get()
+            if target is None:
+                return
+            index, chat_id = target
+            res = await self._send(chat_id)
+            if res is None:
+                self.stats.failed += 1
+            elif res["ok"]:
+                self.stats.sent += 1
+            elif res.get("error_code") == 403 or any(
+                i in res.get("description", "").lower() for i in UNREACHABLE
+            ):
+                self.stats.blocked.append(chat_id)
+            else:
+                logging.debug([chat_id, res])
+                self.stats.failed += 1
+            self._finish(index)
+
+    def _report(self):
+        self._save_checkpoint()
+        if self.progress is not None:
+            self.progress(self.stats)
+        logging.debug(self.stats)
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self._report()
+
+    async def run(self) -> BroadcastStats:
+        self._load_checkpoint()
+        self.stats.started = time.monotonic()
+        targets = asyncio.Queue(self.concurrency * 2)
+        tasks = [asyncio.create_task(self._produce(targets))] + [
+            asyncio.create_task(self._worker(targets))
+            for _ in range(self.concurrency)
+        ]
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # nothing may be sent after the final checkpoint,
+            # a resumed run would send it again
+            await cancel_tasks(tasks + [reporter])
+            self._report()
+        return self.stats
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Set
+
+_MISS = object()
+
+# updates after which a cached member (and admin list) is stale,
+# Telegram only sends them when they are in allowed_updates
+CACHE_UPDATES = ("chat_member", "my_chat_member")
+
+# service message fields after which cached chat info is stale
+CHAT_CHANGES = (
+    "new_chat_members",
+    "left_chat_member",
+    "new_chat_title",
+    "new_chat_photo",
+    "delete_chat_photo",
+    "pinned_message",
+    "migrate_to_chat_id",
+)
+
+
+class RequestCache:
+    """
+    Read-through cache of API results by key, e.g.
+    ("getChatMember", chat_id, user_id). Keys whose second item is
+    a chat id can be dropped all at once with invalidate_chat.
+
+    Entries live `ttl` seconds, at most `size` of them are kept,
+    least recently used first out. Concurrent misses of one key
+    share a single request, only successful responses are kept.
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 60):
+        self.size = size
+        self.ttl = ttl
+        # key -> (response, expires)
+        self.entries: OrderedDict = OrderedDict()
+        self.by_chat: Dict[Any, Set[Hashable]] = {}
+        self.inflight: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key: Hashable):
+        entry = self.entries.get(key)
+        if entry is None:
+            return _MISS
+        if entry[1] < time.monotonic():
+            self._remove(key)
+            return _MISS
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def _remove(self, key: Hashable):
+        del self.entries[key]
+        if len(key) > 1:
+            keys = self.by_chat.get(key[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_chat[key[1]]
+
+    def put(self, key: Hashable, response: dict):
+        self.entries[key] = (response, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        if len(key) > 1:
+            self.by_chat.setdefault(key[1], set()).add(key)
+        if len(self.entries) > self.size:
+            self._remove(next(iter(self.entries)))
+
+    async def get(
+        self, key: Hashable, fetch: Callable[[], Awaitable[dict]]
+    ) -> dict:
+        response = self._lookup(key)
+        if response is not _MISS:
+            self.hits += 1
+            return response
+        self.misses += 1
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.create_task(
+                self._load(key, fetch)
+            )
+        # a caller giving up doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, fetch: Callable) -> dict:
+        try:
+            response = await fetch()
+        finally:
+            current = self.inflight.get(key) is asyncio.current_task()
+            if current:
+                del self.inflight[key]
+        # not kept if it was invalidated while being fetched
+        if current and response.get("ok"):
+            self.put(key, response)
+        return response
+
+    def has_chat(self, chat_id: Any) -> bool:
+        """
+        Whether anything of the chat is cached or being fetched.
+        """
+        if chat_id in self.by_chat:
+            return True
+        return any(len(i) > 1 and i[1] == chat_id for i in self.inflight)
+
+    def invalidate(self, key: Hashable):
+        if key in self.entries:
+            self._remove(key)
+        self.inflight.pop(key, None)
+
+    def invalidate_chat(self, chat_id: Any):
+        for key in list(self.by_chat.get(chat_id, ())):
+            self._remove(key)
+        for key in list(self.inflight):
+            if len(key) > 1 and key[1] == chat_id:
+                del self.inflight[key]
+
+    def clear(self):
+        self.entries.clear()
+        self.by_chat.clear()
+        self.inflight.clear()
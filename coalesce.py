@@ -0,0 +1,115 @@
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Union
+
+NOT_MODIFIED = "message is not modified"
+
+
+class _Pending:
+    __slots__ = ("method", "payload", "chat_id", "futures", "handle")
+
+    def __init__(self, method: str, payload: dict, chat_id: Any):
+        self.method = method
+        self.payload = payload
+        self.chat_id = chat_id
+        self.futures: List[asyncio.Future] = []
+        self.handle = None
+
+
+class Coalescer:
+    """
+    Holds outgoing requests for `window` seconds. A request with the
+    same key (e.g. an edit of the same message) coming in meanwhile
+    replaces the held one, and every caller gets the result of the
+    request that was actually sent.
+
+    Requests repeating the last sent payload of their key, and
+    "message is not modified" errors, count as successful no-ops.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, dict, Any], Awaitable[dict]],
+        window: float = 0.3,
+        remember: int = 1024,
+    ):
+        self.send = send
+        self.window = window
+        self.remember = remember
+        self.pending: Dict[Hashable, _Pending] = {}
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.last_sent = OrderedDict()
+        self.tasks: set = set()
+
+    async def submit(
+        self, key: Hashable, method: str, payload: dict, chat_id: Any = None
+    ) -> dict:
+        loop = asyncio.get_running_loop()
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = _Pending(method, payload, chat_id)
+            entry.handle = loop.call_later(self.window, self._start, key)
+        else:
+            entry.payload = payload
+        future = loop.create_future()
+        entry.futures.append(future)
+        return await future
+
+    def _start(self, key: Hashable):
+        task = asyncio.create_task(self._flush(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _flush(self, key: Hashable):
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return
+        entry.handle.cancel()
+        # requests with the same key go out one after another
+        previous = self.inflight.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self.inflight[key] = done
+        try:
+            if previous is not None:
+                await previous
+            result = await self._send(key, entry)
+        except Exception as e:
+            for future in entry.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            done.set_result(None)
+            if self.inflight.get(key) is done:
+                del self.inflight[key]
+        for future in entry.futures:
+            if not future.done():
+                future.set_result(result)
+
+    async def _send(self, key: Hashable, entry: _Pending) -> dict:
+        if self.last_sent.get(key) == entry.payload:
+            return {"ok": True, "result": True}
+        result = await self.send(entry.method, entry.payload, entry.chat_id)
+        if not result["ok"] and NOT_MODIFIED in result.get(
+            "description", ""
+        ):
+            result = {"ok": True, "result": True}
+        if result["ok"]:
+            self.last_sent[key] = entry.payload
+            self.last_sent.move_to_end(key)
+            if len(self.last_sent) > self.remember:
+                self.last_sent.popitem(last=False)
+        return result
+
+    async def flush(self, timeout: Union[float, None] = None) -> bool:
+        """
+        Sends everything held right away, and waits for
+        what is being sent already.
+        False if `timeout` ran out first.
+        """
+        for key in list(self.pending):
+            self._start(key)
+        if not self.tasks:
+            return True
+        _, pending = await asyncio.wait(list(self.tasks), timeout=timeout)
+        return not pending
@@ -0,0 +1,254 @@
+import html
+from typing import Any, Callable, Dict, Iterable, List, Union
+
+# Telegram counts entity offsets and lengths in UTF-16 code units,
+# characters outside the BMP (most emoji) take two of them.
+# Everything here is a single pass over the text plus sorting the
+# entities, instead of slicing the text once per entity.
+
+
+class Span:
+    """
+    An entity with offsets converted to indices of the Python string.
+    """
+
+    __slots__ = ("type", "start", "end", "text", "entity")
+
+    def __init__(self, type: str, start: int, end: int, text: str, entity):
+        self.type = type
+        self.start = start
+        self.end = end
+        self.text = text
+        self.entity = entity  # the raw dict
+
+    def __repr__(self):
+        return "Span(%s, %d, %d, %r)" % (
+            self.type,
+            self.start,
+            self.end,
+            self.text,
+        )
+
+
+def _raw(entity) -> dict:
+    return entity if isinstance(entity, dict) else entity.to_dict()
+
+
+def _indices(text: str, offsets: Iterable[int]) -> Union[Dict, None]:
+    """
+    UTF-16 offset -> string index, None if they are the same.
+    """
+    if text.isascii() or len(text.encode("utf-16-le")) == 2 * len(text):
+        return None
+    targets = sorted(set(offsets))
+    found = {}
+    t = 0
+    utf16 = 0
+    for index, char in enumerate(text):
+        while t < len(targets) and targets[t] <= utf16:
+            found[targets[t]] = index
+            t += 1
+        if t == len(targets):
+            return found
+        utf16 += 2 if ord(char) > 0xFFFF else 1
+    for target in targets[t:]:
+        found[target] = len(text)
+    return found
+
+
+def parse_entities(text: Union[str, None], entities) -> List[Span]:
+    """
+    Spans of raw entities (or MessageEntity), outer ones first.
+    """
+    if not text or not entities:
+        return []
+    entities = [_raw(i) for i in entities]
+    indices = _indices(
+        text,
+        [i["offset"] for i in entities]
+        + [i["offset"] + i["length"] for i in entities],
+    )
+    spans = []
+    for entity in entities:
+        start = entity["offset"]
+        end = start + entity["length"]
+        if indices is not None:
+            start = indices[start]
+            end = indices[end]
+        spans.append(Span(entity["type"], start, end, text[start:end], entity))
+    spans.sort(key=lambda i: (i.start, -i.end))
+    return spans
+
+
+def get_commands(spans: List[Span]) -> List[str]:
+    """
+    "/start@SomeBot" -> "start"
+    """
+    return [
+        i.text[1:].split("@", 1)[0].lower()
+        for i in spans
+        if i.type == "bot_command"
+    ]
+
+
+def get_mentions(spans: List[Span]) -> List[Any]:
+    """
+    "@username" strings, and user ids of mentions of users
+    without a username (text_mention).
+    """
+    found = []
+    for i in spans:
+        if i.type == "mention":
+            found.append(i.text)
+        elif i.type == "text_mention":
+            found.append(i.entity["user"]["id"])
+    return found
+
+
+def get_urls(spans: List[Span]) -> List[str]:
+    """
+    Links written out in the text and hidden behind it.
+    """
+    found = []
+    for i in spans:
+        if i.type == "url":
+            found.append(i.text)
+        elif i.type == "text_link":
+            found.append(i.entity["url"])
+    return found
+
+
+def _render(
+    text: str,
+    spans: List[Span],
+    tags: Callable[[Span], Union[tuple, None]],
+    escape: Callable[[str, bool], str],
+) -> str:
+    out = []
+    stack = []  # open spans with their closing tag
+    code = 0  # how deep inside code / pre
+    pos = 0
+    i = 0
+    boundaries = sorted({p for s in spans for p in (s.start, s.end)})
+    for point in boundaries:
+        out.append(escape(text[pos:point], code > 0))
+        pos = point
+        while stack and stack[-1][0].end <= point:
+            span, closing = stack.pop()
+            out.append(closing)
+            if span.type in ("code", "pre"):
+                code -= 1
+        while i < len(spans) and spans[i].start == point:
+            span = spans[i]
+            i += 1
+            pair = tags(span) if span.end > span.start else None
+            if pair is None:
+                continue
+            out.append(pair[0])
+            stack.append((span, pair[1]))
+            if span.type in ("code", "pre"):
+                code += 1
+    out.append(escape(text[pos:], False))
+    while stack:
+        out.append(stack.pop()[1])
+    return "".join(out)
+
+
+_HTML = {
+    "bold": ("<b>", "</b>"),
+    "italic": ("<i>", "</i>"),
+    "underline": ("<u>", "</u>"),
+    "strikethrough": ("<s>", "</s>"),
+    "spoiler": ("<tg-spoiler>", "</tg-spoiler>"),
+    "code": ("<code>", "</code>"),
+    "blockquote": ("<blockquote>", "</blockquote>"),
+}
+
+
+def _html_tags(span: Span) -> Union[tuple, None]:
+    entity = span.entity
+    if span.type == "pre":
+        language = entity.get("language")
+        if language:
+            return (
+                '<pre><code class="language-%s">'
+                % html.escape(language),
+                "</code></pre>",
+            )
+        return "<pre>", "</pre>"
+    if span.type == "text_link":
+        return '<a href="%s">' % html.escape(entity["url"]), "</a>"
+    if span.type == "text_mention":
+        return (
+            '<a href="tg://user?id=%d">' % entity["user"]["id"],
+            "</a>",
+        )
+    if span.type == "custom_emoji":
+        return (
+            '<tg-emoji emoji-id="%s">' % entity["custom_emoji_id"],
+            "</tg-emoji>",
+        )
+    return _HTML.get(span.type)
+
+
+def to_html(text: Union[str, None], entities) -> str:
+    """
+    Text with entities as Telegram's HTML parse mode, with the rest
+    escaped. `entities` are raw entities or spans from parse_entities.
+    """
+    if not text:
+        return ""
+    spans = _spans(text, entities)
+    return _render(
+        text, spans, _html_tags, lambda s, code: html.escape(s, False)
+    )
+
+
+_MARKDOWN = {
+    "bold": ("*", "*"),
+    "italic": ("_", "_\r"),  # \r ends italic before an underline
+    "underline": ("__", "__"),
+    "strikethrough": ("~", "~"),
+    "spoiler": ("||", "||"),
+    "code": ("`", "`"),
+}
+_MARKDOWN_SPECIAL = {ord(i): "\\" + i for i in "_*[]()~`>#+-=|{}.!\\"}
+_MARKDOWN_CODE = {ord(i): "\\" + i for i in "`\\"}
+_MARKDOWN_URL = {ord(i): "\\" + i for i in ")\\"}
+
+
+def _markdown_tags(span: Span) -> Union[tuple, None]:
+    entity = span.entity
+    if span.type == "pre":
+        return "```%s\n" % (entity.get("language") or ""), "\n```"
+    if span.type == "text_link":
+        return "[", "](%s)" % entity["url"].translate(_MARKDOWN_URL)
+    if span.type == "text_mention":
+        return "[", "](tg://user?id=%d)" % entity["user"]["id"]
+    if span.type == "custom_emoji":
+        return "![", "](tg://emoji?id=%s)" % entity["custom_emoji_id"]
+    return _MARKDOWN.get(span.type)
+
+
+def to_markdown(text: Union[str, None], entities) -> str:
+    """
+    The same for MarkdownV2. Blockquotes are left as plain text.
+    """
+    if not text:
+        return ""
+    spans = _spans(text, entities)
+    return _render(
+        text,
+        spans,
+        _markdown_tags,
+        lambda s, code: s.translate(
+            _MARKDOWN_CODE if code else _MARKDOWN_SPECIAL
+        ),
+    )
+
+
+def _spans(text: str, entities) -> List[Span]:
+    entities = list(entities or ())
+    if entities and isinstance(entities[0], Span):
+        return entities
+    return parse_entities(text, entities)
@@ -0,0 +1,121 @@
+import io
+import os
+from collections import OrderedDict
+from typing import Any, AsyncIterable, Hashable, Iterable, Union
+
+
+class InputFile:
+    """
+    A file to upload. It is read in chunks while the request is being
+    sent, so it never has to fit in memory. `source` can be a path,
+    a binary file object, bytes, or an iterator / async iterator
+    of bytes chunks.
+
+    Files from paths can be sent again and again (after a 429 too),
+    seekable file objects are rewound, iterators only work once.
+    """
+
+    def __init__(
+        self,
+        source: Union[str, os.PathLike, io.IOBase, bytes, Iterable, Any],
+        filename: Union[str, None] = None,
+        content_type: Union[str, None] = None,
+        cache_key: Union[Hashable, None] = None,
+    ):
+        self.source = source
+        self.content_type = content_type
+        self._cache_key = cache_key
+        self._start = None
+        self._used = False
+        if filename is None:
+            if isinstance(source, (str, os.PathLike)):
+                filename = os.path.basename(source)
+            else:
+                name = getattr(source, "name", None)
+                filename = (
+                    os.path.basename(name) if isinstance(name, str) else None
+                )
+        self.filename = filename or "file"
+        if isinstance(source, io.IOBase) and source.seekable():
+            self._start = source.tell()
+
+    @property
+    def cache_key(self) -> Union[Hashable, None]:
+        """
+        Same key, same file: used to send a file_id instead of
+        uploading it again. Paths get one from their size and mtime.
+        """
+        if self._cache_key is not None:
+            return self._cache_key
+        if isinstance(self.source, (str, os.PathLike)):
+            stat = os.stat(self.source)
+            return (
+                os.path.abspath(self.source),
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+        return None
+
+    def payload(self):
+        """
+        Something aiohttp streams from, made anew for every attempt.
+        """
+        source = self.source
+        if isinstance(source, (str, os.PathLike)):
+            # aiohttp reads it in chunks and closes it when done
+            return open(source, "rb")
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return source
+        if self._start is not None:
+            source.seek(self._start)
+            return source
+        if self._used:
+            raise RuntimeError("This file can only be sent once")
+        self._used = True
+        if isinstance(source, io.IOBase) or hasattr(source, "__aiter__"):
+            return source
+        return _iterate(source)
+
+
+async def _iterate(chunks: Iterable[bytes]) -> AsyncIterable[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+def as_input_file(value: Any) -> Any:
+    """
+    Wraps anything uploadable into InputFile, strings
+    (file_id or URL) are left as they are.
+    """
+    if value is None or isinstance(value, (str, InputFile)):
+        return value
+    return InputFile(value)
+
+
+class FileIdCache:
+    """
+    LRU map of InputFile.cache_key -> file_id of an earlier upload.
+    """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.ids = OrderedDict()
+
+    def get(self, key: Union[Hashable, None]) -> Union[str, None]:
+        if key is None:
+            return None
+        file_id = self.ids.get(key)
+        if file_id is not None:
+            self.ids.move_to_end(key)
+        return file_id
+
+    def put(self, key: Union[Hashable, None], file_id: str):
+        if key is None:
+            return
+        self.ids[key] = file_id
+        self.ids.move_to_end(key)
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+    def discard(self, key: Union[Hashable, None]):
+        self.ids.pop(key, None)
@@ -0,0 +1,218 @@
+import re
+from typing import Any, Iterable, List, Pattern, Tuple, Union
+
+from .state_storage import current_state
+
+
+def _get(obj, name: str):
+    # typed objects and raw dicts (inline queries, polls...) alike
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def _text(obj) -> Union[str, None]:
+    for name in ("text", "caption", "data", "query"):
+        value = _get(obj, name)
+        if value is not None:
+            return value
+    return None
+
+
+def _chat(obj):
+    chat = _get(obj, "chat")
+    if chat is None:
+        message = _get(obj, "message")  # callback queries
+        if message is not None:
+            chat = _get(message, "chat")
+    return chat
+
+
+def parse_command(obj) -> Union[Tuple[str, Union[str, None]], None]:
+    """
+    "/start@SomeBot payload" -> ("start", "somebot"),
+    "/start payload" -> ("start", None)
+    """
+    text = _get(obj, "text")
+    if not text or text[0] != "/":
+        return None
+    command = text[1:].split(None, 1)[0] if len(text) > 1 else ""
+    command, _, target = command.lower().partition("@")
+    return command, target or None
+
+
+def get_command(obj, username: Union[str, None] = None) -> Union[str, None]:
+    """
+    "/start@SomeBot payload" -> "start", None if the command
+    is addressed to a bot other than `username` (when known).
+    """
+    command = parse_command(obj)
+    if command is None:
+        return None
+    if (
+        command[1] is not None
+        and username is not None
+        and command[1] != username.lower()
+    ):
+        return None
+    return command[0]
+
+
+def _names(value: Union[str, Iterable[str], None]):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = (value,)
+    return frozenset(value)
+
+
+class Filter:
+    """
+    Conditions a handler is registered with, all of the given ones
+    must match for it to be called. `commands` and `callback_data`
+    (a prefix) are also used by Router to skip handlers early.
+    `state` is a name (or names) of FSMContext states the user has
+    to be in, "*" for any state.
+    """
+
+    __slots__ = (
+        "commands",
+        "regex",
+        "chat_types",
+        "content_types",
+        "callback_data",
+        "state",
+    )
+
+    def __init__(
+        self,
+        commands: Union[str, Iterable[str], None] = None,
+        regex: Union[str, Pattern, None] = None,
+        chat_types: Union[str, Iterable[str], None] = None,
+        content_types: Union[str, Iterable[str], None] = None,
+        callback_data: Union[str, None] = None,
+        state: Union[str, Iterable[str], None] = None,
+    ):
+        commands = _names(commands)
+        self.commands = (
+            frozenset(i.lstrip("/").lower() for i in commands)
+            if commands is not None
+            else None
+        )
+        self.regex = re.compile(regex) if isinstance(regex, str) else regex
+        self.chat_types = _names(chat_types)
+        self.content_types = _names(content_types)
+        self.callback_data = callback_data
+        self.state = _names(state)
+
+    def empty(self) -> bool:
+        return all(getattr(self, i) is None for i in self.__slots__)
+
+    def check(self, obj) -> bool:
+        """
+        Everything but commands, which are matched by Router.
+        """
+        if self.callback_data is not None:
+            data = _get(obj, "data")
+            if data is None or not data.startswith(self.callback_data):
+                return False
+        if self.chat_types is not None:
+            chat = _chat(obj)
+            if chat is None or _get(chat, "type") not in self.chat_types:
+                return False
+        if self.content_types is not None:
+            if _get(obj, "content_type") not in self.content_types:
+                return False
+        if self.state is not None:
+            context = current_state()
+            state = context.state if context is not None else None
+            if state is None or (
+                state not in self.state and "*" not in self.state
+            ):
+                return False
+        if self.regex is not None:
+            text = _text(obj)
+            if text is None or self.regex.search(text) is None:
+                return False
+        return True
+
+
+class PrefixTrie:
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix: str, value: Any):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # None can't clash with a character
+        node.setdefault(None, []).append(value)
+
+    def find(self, string: str) -> List[Any]:
+        """
+        Values of every prefix of `string`.
+        """
+        node = self.root
+        found = list(node.get(None, ()))
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            found += node.get(None, ())
+        return found
+
+
+class Router:
+    """
+    Handlers of one update type. Command handlers are looked up by
+    command name and callback data handlers by prefix, so an update
+    is only checked against the handlers that can match it.
+    """
+
+    def __init__(self, handlers: Iterable[Tuple[Any, Union[Filter, None]]]):
+        self.generic = []
+        self.commands = {}
+        self.prefixes = PrefixTrie()
+        self.has_prefixes = False
+        filtered = False
+        for order, (func, flt) in enumerate(handlers):
+            entry = (order, func, flt)
+            if flt is None:
+                self.generic.append(entry)
+                continue
+            filtered = True
+            if flt.commands is not None:
+                for command in flt.commands:
+                    self.commands.setdefault(command, []).append(entry)
+            elif flt.callback_data is not None:
+                self.prefixes.add(flt.callback_data, entry)
+                self.has_prefixes = True
+            else:
+                self.generic.append(entry)
+        # nothing to check, match() returns it as is
+        self.plain = (
+            None if filtered else tuple(func for _, func, _ in self.generic)
+        )
+
+    def match(self, obj, username: Union[str, None] = None) -> Iterable:
+        """
+        `username` of the bot, commands for other bots don't match.
+        """
+        if self.plain is not None:
+            return self.plain
+        candidates = self.generic
+        if self.commands:
+            command = get_command(obj, username)
+            if command is not None and command in self.commands:
+                candidates = sorted(candidates + self.commands[command])
+        if self.has_prefixes:
+            data = _get(obj, "data")
+            if data is not None:
+                found = self.prefixes.find(data)
+                if found:
+                    candidates = sorted(candidates + found)
+        return [
+            func
+            for _, func, flt in candidates
+            if flt is None or flt.check(obj)
+        ]
@@ -0,0 +1,146 @@
+import asyncio
+from typing import Dict, Union
+
+import aiohttp
+
+from .bot import Bot, Worker, make_session, wait_for_signal
+
+
+class BotHost:
+    """
+    Runs many bots in one event loop. They share one connection
+    pool for requests, one for long polls, and one pool of `workers`
+    worker tasks (growing up to `max_workers` under load). Each bot
+    keeps its own queue (with its overflow policy), rate limiter,
+    handlers and offset.
+
+    A bot has at most `per_bot` updates queued or being handled in
+    the shared pool at a time, so one flooded bot can't starve the
+    others. The bots' own `n` workers and `ordered` aren't used.
+    Use per_bot=1 to keep each bot's updates in order.
+
+    Bots can be added and removed while the host is running.
+    """
+
+    def __init__(
+        self,
+        workers: int = 16,
+        max_workers: Union[int, None] = None,
+        scale_interval: float = 1.0,
+        per_bot: int = 4,
+        pool_size: int = 100,
+        pool_size_per_host: int = 0,
+        dns_cache_ttl: Union[int, None] = 300,
+        keepalive_timeout: float = 30,
+    ):
+        self.per_bot = per_bot
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.bots: Dict[str, Bot] = {}
+        self.session: Union[aiohttp.ClientSession, None] = None
+        self.poll_session: Union[aiohttp.ClientSession, None] = None
+        # (bot, update, slots) waiting for a worker
+        self.queue = asyncio.Queue(max_workers or workers)
+        self.worker = Worker(
+            None,
+            self.queue,
+            workers,
+            None,
+            self._handle,
+            max_workers=max_workers,
+            scale_interval=scale_interval,
+        )
+        self._feeders: Dict[str, asyncio.Task] = {}
+        self._started = False
+
+    def _make_session(self, limit: int) -> aiohttp.ClientSession:
+        return make_session(
+            limit,
+            self.pool_size_per_host,
+            self.dns_cache_ttl,
+            self.keepalive_timeout,
+        )
+
+    async def _handle(self, item):
+        bot, update, slots = item
+        try:
+            await bot._handle_update(update)
+        finally:
+            slots.release()
+
+    async def _feed(self, bot: Bot):
+        slots = asyncio.Semaphore(self.per_bot)
+        while True:
+            update = await bot.queue.get()
+            await slots.acquire()
+            await self.queue.put((bot, update, slots))
+
+    async def _run(self, bot: Bot):
+        bot.use_sessions(self.session, self.poll_session)
+        self._feeders[bot.token] = asyncio.create_task(self._feed(bot))
+        await bot.poller.start()
+
+    async def start(self):
+        if self.session is None:
+            self.session = self._make_session(self.pool_size)
+            # every bot holds a long poll open all the time
+            self.poll_session = self._make_session(0)
+        await self.worker.start()
+        self._started = True
+        for bot in self.bots.values():
+            await self._run(bot)
+
+    async def add(self, bot: Bot) -> Bot:
+        if bot.token in self.bots:
+            raise ValueError("A bot with this token is already hosted")
+        self.bots[bot.token] = bot
+        if self._started:
+            await self._run(bot)
+        return bot
+
+    async def remove(
+        self, bot: Union[Bot, str], timeout: Union[float, None] = 30
+    ) -> bool:
+        """
+        Stops the bot like Bot.stop: its received updates get
+        `timeout` seconds to be handled, then the offset is
+        confirmed. Returns whether everything was handled.
+        """
+        token = bot if isinstance(bot, str) else bot.token
+        bot = self.bots.pop(token)
+        # the feeder keeps handing its queue over while it drains
+        drained = await bot.stop(timeout)
+        feeder = self._feeders.pop(token, None)
+        if feeder is not None:
+            feeder.cancel()
+        return drained
+
+    async def close(self, timeout: Union[float, None] = 30):
+        await asyncio.gather(
+            *(self.remove(token, timeout) for token in list(self.bots))
+        )
+        await self.worker.stop()
+        if self.session is not None:
+            await self.session.close()
+            await self.poll_session.close()
+            self.session = self.poll_session = None
+        self._started = False
+
+    def run(self, drain_timeout: Union[float, None] = 30):
+        """
+        Runs the hosted bots until SIGINT or SIGTERM.
+        """
+
+        async def main():
+            await self.start()
+            try:
+                await wait_for_signal()
+            finally:
+                await self.close(drain_timeout)
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,106 @@
+"""
+JSON encoding used for requests and responses.
+
+orjson or ujson are used when installed, the standard library
+otherwise. Another codec can be plugged in with `use`. Call these
+through the module (json_codec.dumps) so that `use` takes effect.
+"""
+import json
+from collections import OrderedDict
+from typing import Any, Callable, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+def _std_dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+if orjson is not None:
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    loads: Callable[[Union[bytes, str]], Any] = orjson.loads
+elif ujson is not None:
+
+    def dumps(obj: Any) -> str:
+        return ujson.dumps(obj, ensure_ascii=False)
+
+    loads = ujson.loads
+else:
+    dumps = _std_dumps
+    loads = json.loads  # takes utf-8 bytes as well
+
+
+def use(
+    dumps_func: Callable[[Any], str],
+    loads_func: Callable[[Union[bytes, str]], Any],
+):
+    global dumps, loads, _cache_markups
+    dumps = dumps_func
+    loads = loads_func
+    _cache_markups = True
+    _markups.clear()
+
+
+def freeze(obj: Any) -> str:
+    """
+    Serializes a reply_markup (or any other JSON field) once,
+    so that a keyboard sent many times isn't encoded every time.
+    Send methods pass strings through as they are.
+    """
+    return dumps(obj)
+
+
+# keyboards sent again as the same object are encoded once,
+# orjson encodes them about as fast as they can be compared
+MARKUP_CACHE_SIZE = 256
+_cache_markups = orjson is None
+
+# id -> (markup, what it was when encoded, encoded), oldest first;
+# holding the markup keeps its id from being reused
+_markups: OrderedDict = OrderedDict()
+
+
+def _encode_markup(value: Any) -> str:
+    entry = _markups.get(id(value))
+    # comparing is much cheaper than encoding with json or ujson,
+    # and catches a keyboard that was changed in place since
+    if entry is not None and entry[0] is value and entry[1] == value:
+        _markups.move_to_end(id(value))
+        return entry[2]
+    encoded = dumps(value)
+    _markups[id(value)] = (value, loads(encoded), encoded)
+    _markups.move_to_end(id(value))
+    if len(_markups) > MARKUP_CACHE_SIZE:
+        _markups.popitem(last=False)
+    return encoded
+
+
+def form_value(value: Any, field: Union[str, None] = None) -> str:
+    """
+    Encodes one field of a form-encoded request
+    the way the Bot API expects it.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if (
+        _cache_markups
+        and field == "reply_markup"
+        and isinstance(value, (dict, list))
+    ):
+        return _encode_markup(value)
+    return dumps(value)
@@ -0,0 +1,30 @@
+import asyncio
+import logging
+from typing import Iterable
+
+# seconds a cancelled task gets to finish before shutdown moves on
+CANCEL_TIMEOUT = 5.0
+
+
+async def cancel_tasks(
+    tasks: Iterable[asyncio.Future], timeout: float = CANCEL_TIMEOUT
+) -> bool:
+    """
+    Cancels `tasks` and waits at most `timeout` seconds for them.
+    A task that swallows its cancellation is logged and left behind
+    instead of hanging the caller. False if any was left behind.
+    """
+    tasks = list(tasks)
+    if not tasks:
+        return True
+    for task in tasks:
+        task.cancel()
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in done:
+        if not task.cancelled():
+            task.exception()  # retrieved, so asyncio doesn't warn about it
+    for task in pending:
+        logging.error(
+            "%r did not stop within %ss of being cancelled", task, timeout
+        )
+    return not pending
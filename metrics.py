@@ -0,0 +1,195 @@
+import logging
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Tuple, Union
+
+from aiohttp import web
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Span:
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        self.metrics.observe(self.name + "_seconds", duration, **self.labels)
+        if exc_type is not None:
+            self.metrics.inc(self.name + "_errors", **self.labels)
+        if self.metrics.on_span is not None:
+            try:
+                self.metrics.on_span(self.name, self.labels, duration, exc)
+            except Exception:
+                # a broken tracer must not fail what was timed
+                logging.exception("on_span failed")
+        return False
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms filled in by the bot
+    (polls, queue, handlers, API requests). render() returns them
+    in the Prometheus text format, serve() exposes them over HTTP.
+
+    `on_span(name, labels, duration, exception)` is called after
+    every timed operation and can forward it to a tracing system.
+    """
+
+    def __init__(
+        self,
+        prefix: str = "telegram_bot",
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+        on_span: Union[Callable[[str, dict, float, Any], Any], None] = None,
+    ):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.on_span = on_span
+        self.counters: Dict[tuple, float] = {}
+        self.gauges: Dict[tuple, Callable[[], float]] = {}
+        self.histograms: Dict[tuple, Histogram] = {}
+        self.runner: Union[web.AppRunner, None] = None
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        # values as strings, as rendered, so that keys always sort
+        # (a label can be None in one place and an int in another)
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, func: Callable[[], float], **labels):
+        """
+        `func` is called on every render.
+        """
+        self.gauges[self._key(name, labels)] = func
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def span(self, name: str, **labels) -> Span:
+        """
+        with metrics.span("api_request", method="sendMessage"): ...
+        """
+        return Span(self, name, labels)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [
+            '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"'))
+            for k, v in labels
+        ]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} {}".format(name, kind))
+
+        for (name, labels), value in sorted(self.counters.items()):
+            name = "{}_{}_total".format(self.prefix, name)
+            declare(name, "counter")
+            lines.append(name + self._labels(labels) + " " + str(value))
+        for (name, labels), func in sorted(
+            self.gauges.items(), key=lambda i: i[0]
+        ):
+            name = "{}_{}".format(self.prefix, name)
+            declare(name, "gauge")
+            lines.append(name + self._labels(labels) + " " + str(func()))
+        for (name, labels), histogram in sorted(
+            self.histograms.items(), key=lambda i: i[0]
+        ):
+            name = "{}_{}".format(self.prefix, name)
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(
+                self.buckets + (float("inf"),), histogram.counts
+            ):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    name
+                    + "_bucket"
+                    + self._labels(labels, 'le="{}"'.format(le))
+                    + " "
+                    + str(cumulative)
+                )
+            lines.append(
+                name + "_sum" + self._labels(labels) + " " + str(histogram.sum)
+            )
+            lines.append(
+                name
+                + "_count"
+                + self._labels(labels)
+                + " "
+                + str(histogram.count)
+            )
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def serve(self, host: str = "0.0.0.0", port: int = 9100):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -1,7 +1,21 @@
 from abc import ABC, abstractmethod
+from typing import Union
+
+from .state_storage import FSMContext, StateStorage, current_state
 
 
 class BaseModule(ABC):
+    # the bot's storage, set by Bot.load_module
+    storage: Union[StateStorage, None] = None
+
+    @property
+    def state(self) -> Union[FSMContext, None]:
+        """
+        State of the user in the update being handled, keep
+        conversation data here instead of in module attributes.
+        """
+        return current_state()
+
     @abstractmethod
     def get_funcs(self):
         """
@@ -15,6 +29,16 @@ class BaseModule(ABC):
             [
                 self.some_function_message,
                 types.Handlers.onMessage
+            ],
+            [
+                self.start,
+                types.Handlers.onMessage,
+                {"commands": "start"}  # filters, see Bot.register
+            ],
+            [
+                self.got_name,
+                types.Handlers.onMessage,
+                {"state": "ask_name"}  # after self.state.set_state
             ]
         ]
         """
@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import os
+import sqlite3
+from collections import deque
+from typing import Union
+
+
+class OffsetStore:
+    """
+    Keeps the id of the first update that isn't handled yet,
+    so that after a restart polling continues from it.
+    """
+
+    def load(self) -> Union[int, None]:
+        raise NotImplementedError
+
+    def save(self, offset: int):
+        raise NotImplementedError
+
+
+class FileOffsetStore(OffsetStore):
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Union[int, None]:
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, offset: int):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+class SQLiteOffsetStore(OffsetStore):
+    """
+    Several bots can share one database, each under its own `key`.
+    """
+
+    def __init__(self, path: str, key: str = "offset"):
+        self.path = path
+        self.key = key
+        with sqlite3.connect(self.path) as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS offsets "
+                "(key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    def load(self) -> Union[int, None]:
+        with sqlite3.connect(self.path) as db:
+            row = db.execute(
+                "SELECT value FROM offsets WHERE key = ?", (self.key,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def save(self, offset: int):
+        with sqlite3.connect(self.path) as db:
+            db.execute(
+                "INSERT OR REPLACE INTO offsets (key, value) VALUES (?, ?)",
+                (self.key, offset),
+            )
+
+
+class UpdateTracker:
+    """
+    Remembers the last `size` update ids to drop duplicates, and
+    which updates are still being handled, to know up to which
+    offset everything is done.
+    """
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.recent = set()
+        self._order = deque()
+        self.pending = set()
+        self._heap = []
+        self.highest: Union[int, None] = None
+        self._progress = asyncio.Event()
+
+    def seen(self, update_id: int) -> bool:
+        return update_id in self.recent
+
+    def begin(self, update_id: int):
+        self.recent.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.size:
+            self.recent.discard(self._order.popleft())
+        self.pending.add(update_id)
+        heapq.heappush(self._heap, update_id)
+        if self.highest is None or update_id > self.highest:
+            self.highest = update_id
+
+    def done(self, update_id: int):
+        if update_id in self.pending:
+            self.pending.remove(update_id)
+            heap = self._heap
+            while heap and heap[0] not in self.pending:
+                heapq.heappop(heap)
+            self._progress.set()
+
+    def watermark(self) -> Union[int, None]:
+        """
+        Every update before this one has been handled.
+        """
+        heap = self._heap
+        if heap:
+            return heap[0]
+        return self.highest + 1 if self.highest is not None else None
+
+    async def wait_progress(self, since: Union[int, None], timeout: float):
+        """
+        Waits until some update is done, returns right away
+        if the watermark is already past `since`.
+        """
+        self._progress.clear()
+        if self.watermark() != since:
+            return
+        # not wait_for: it can swallow a cancellation that comes
+        # in together with the event, and the poller never stops
+        waiter = asyncio.ensure_future(self._progress.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=timeout)
+        finally:
+            waiter.cancel()
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Union
+
+from .bot_types import convert_dict
+from .lifecycle import cancel_tasks
+
+
+class PendingResult:
+    """
+    Result of a pipelined request. Awaiting it gives what the
+    blocking method would have returned, converted only then:
+    None for an error response, while a network error is raised,
+    and CancelledError if the pipeline stopped before sending it.
+    """
+
+    __slots__ = ("future", "typeof")
+
+    def __init__(self, future: asyncio.Future, typeof: Union[str, None]):
+        self.future = future
+        self.typeof = typeof
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    async def _result(self):
+        response = await self.future
+        if not response["ok"]:
+            return None
+        if self.typeof is None:
+            return response["result"]
+        return convert_dict(response["result"], self.typeof)
+
+    def __await__(self):
+        return self._result().__await__()
+
+
+class Pipeline:
+    """
+    Outgoing requests that don't make their sender wait. Requests
+    to one chat are sent one after another in the order they were
+    submitted, different chats go in parallel.
+    """
+
+    def __init__(self, send: Callable[[str, dict, Any, bool], Awaitable]):
+        self.send = send  # (method, payload, chat_id, parse)
+        self.lanes: Dict[Any, deque] = {}
+        self.tasks: set = set()
+
+    def submit(
+        self,
+        method: str,
+        payload: dict,
+        chat_id: Any = None,
+        typeof: Union[str, None] = None,
+        parse: bool = True,
+    ) -> Union[PendingResult, None]:
+        """
+        With parse=False the response isn't even decoded
+        (unless it is an error) and None is returned.
+        """
+        future = asyncio.get_running_loop().create_future() if parse else None
+        lane = self.lanes.get(chat_id)
+        if lane is None:
+            lane = self.lanes[chat_id] = deque()
+            task = asyncio.create_task(self._drain(chat_id, lane))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        lane.append((method, payload, future))
+        if future is None:
+            return None
+        return PendingResult(future, typeof)
+
+    async def _drain(self, chat_id: Any, lane: deque):
+        try:
+            while lane:
+                method, payload, future = lane.popleft()
+                try:
+                    response = await self.send(
+                        method, payload, chat_id, future is not None
+                    )
+                except Exception as e:
+                    if future is None:
+                        logging.exception("%s failed", method)
+                    elif not future.done():
+                        future.set_exception(e)
+                    continue
+                if future is None:
+                    if not response["ok"]:
+                        logging.error("%s failed: %s", method, response)
+                elif not future.done():
+                    future.set_result(response)
+        finally:
+            del self.lanes[chat_id]
+            # cancelled, nobody is going to send these
+            for _, _, future in lane:
+                if future is not None and not future.done():
+                    future.cancel()
+
+    async def flush(self, timeout: Union[float, None] = None) -> bool:
+        """
+        Waits until everything submitted is sent.
+        False if `timeout` ran out first.
+        """
+        if not self.tasks:
+            return True
+        _, pending = await asyncio.wait(list(self.tasks), timeout=timeout)
+        return not pending
+
+    async def stop(self):
+        await cancel_tasks(self.tasks)
@@ -0,0 +1,110 @@
+import asyncio
+import time
+from typing import Dict, Union
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _reserve(self) -> float:
+        """
+        Takes a token, returns how long to wait before using it.
+        Tokens go below zero when several callers are waiting,
+        so each of them gets its own place in line.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    async def acquire(self):
+        wait = self._reserve()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            # the bucket may have been paused while we were sleeping
+            wait = self.paused_until - time.monotonic()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(
+            self.paused_until, time.monotonic() + seconds
+        )
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        return (
+            now >= self.paused_until
+            and self.tokens + (now - self.updated) * self.rate
+            >= self.capacity
+        )
+
+
+class RateLimiter:
+    """
+    Keeps outgoing messages under Telegram's limits: about 30
+    messages per second overall, one per second to a private
+    chat and 20 per minute to a group or channel.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        global_burst: float = 30,
+        private_rate: float = 1,
+        private_burst: float = 3,
+        group_rate: float = 20 / 60,
+        group_burst: float = 5,
+        max_buckets: int = 10000,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_buckets = max_buckets
+        self.buckets: Dict[Union[int, str], TokenBucket] = {}
+
+    def _bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        if isinstance(chat_id, str) and not chat_id.startswith("@"):
+            chat_id = int(chat_id)
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self._prune()
+            # groups and channels have negative ids or @usernames
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self):
+        # a full bucket behaves exactly like a new one
+        for chat_id in [k for k, v in self.buckets.items() if v.idle()]:
+            del self.buckets[chat_id]
+
+    async def acquire(self, chat_id: Union[int, str, None] = None):
+        if chat_id is not None:
+            await self._bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def pause(self, chat_id: Union[int, str, None], seconds: float):
+        """
+        Called on "429 Too Many Requests": holds back
+        only the chat that hit the limit.
+        """
+        if chat_id is None:
+            self.global_bucket.pause(seconds)
+        else:
+            self._bucket(chat_id).pause(seconds)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+from typing import Callable, List, Union
+
+from .bot import wait_for_signal
+from .bot_types import get_update_key
+
+
+async def _serve(factory: Callable, inbox, drain_timeout: float):
+    bot = factory()
+    await bot.open()
+    await bot.worker.start()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, inbox.get)
+            if update is None:
+                break
+            await bot.queue.put(update)
+    finally:
+        await bot.stop(drain_timeout)
+
+
+def _worker_main(factory: Callable, inbox, drain_timeout: float):
+    # Ctrl+C reaches the whole process group, the parent
+    # stops the workers in order once it has stopped receiving
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(factory, inbox, drain_timeout))
+
+
+class ShardedRunner:
+    """
+    Runs one bot on several processes. This process only receives
+    updates (by polling or webhook) and hands every update to one of
+    `processes` worker processes, chosen by its chat, so updates of
+    one chat always go to the same process and stay in order.
+
+    `factory` builds a ready Bot (modules loaded and so on) and is
+    called once here and once in every worker process, so it has to
+    be picklable, e.g. a module level function. Give the Bot
+    ordered=True for the order to be kept inside a process as well.
+    """
+
+    def __init__(
+        self,
+        factory: Callable,
+        processes: Union[int, None] = None,
+        inbox_size: int = 1000,
+        start_method: str = "spawn",
+        drain_timeout: float = 30,
+    ):
+        self.factory = factory
+        self.processes_amount = processes or os.cpu_count() or 1
+        self.inbox_size = inbox_size
+        self.drain_timeout = drain_timeout
+        self.context = multiprocessing.get_context(start_method)
+        self.inboxes: List = []
+        self.processes: List = []
+        self.bot = None
+        self._distributor: Union[asyncio.Task, None] = None
+
+    async def start(
+        self, webhook_url: Union[str, None] = None, **webhook_kwargs
+    ):
+        for _ in range(self.processes_amount):
+            inbox = self.context.Queue(self.inbox_size)
+            process = self.context.Process(
+                target=_worker_main,
+                args=(self.factory, inbox, self.drain_timeout),
+                daemon=True,
+            )
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        self.bot = self.factory()
+        if webhook_url is not None:
+            await self.bot.start_webhook(
+                webhook_url, run_workers=False, **webhook_kwargs
+            )
+        else:
+            await self.bot.start(run_workers=False)
+        self._distributor = asyncio.create_task(self._distribute())
+
+    async def _distribute(self):
+        loop = asyncio.get_running_loop()
+        shards = len(self.inboxes)
+        while True:
+            update = await self.bot.queue.get()
+            inbox = self.inboxes[hash(get_update_key(update)) % shards]
+            try:
+                inbox.put_nowait(update)
+            except queue.Full:
+                # that process is behind, wait for it without
+                # blocking the loop (and so the poller)
+                await loop.run_in_executor(None, inbox.put, update)
+            # handed over, as far as this process is concerned
+            self.bot.tracker.done(update["update_id"])
+
+    async def stop(self, timeout: Union[float, None] = None):
+        """
+        Stops receiving, hands over what was received, and lets every
+        worker process handle what it got, up to drain_timeout (or
+        `timeout`) seconds before it is killed.
+        """
+        timeout = self.drain_timeout if timeout is None else timeout
+        if self.bot is not None:
+            # the distributor empties the queue while the bot drains,
+            # updates count as handled once handed over
+            await self.bot.stop(timeout)
+            self.bot = None
+        if self._distributor is not None:
+            self._distributor.cancel()
+            self._distributor = None
+        loop = asyncio.get_running_loop()
+        for inbox in self.inboxes:
+            await loop.run_in_executor(None, inbox.put, None)
+        for process in self.processes:
+            # a bit longer than the process itself waits for handlers
+            await loop.run_in_executor(None, process.join, timeout + 5)
+            if process.is_alive():
+                logging.warning("Worker process %s killed", process.pid)
+                process.kill()
+        self.inboxes = []
+        self.processes = []
+
+    def run(self, webhook_url: Union[str, None] = None, **webhook_kwargs):
+        async def main():
+            await self.start(webhook_url, **webhook_kwargs)
+            try:
+                await wait_for_signal()
+            finally:
+                await self.stop()
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
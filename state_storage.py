@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, Dict, Hashable, Tuple, Union
+
+from . import json_codec
+
+# set by the dispatcher for every update
+state_var: ContextVar = ContextVar("state", default=None)
+
+
+def state_key(value: dict) -> Union[Tuple[Any, Any], None]:
+    """
+    (chat id, user id) of a raw message, callback query and so on,
+    either of them can be None. None if the update has neither.
+    """
+    chat = value.get("chat")
+    if chat is None:
+        message = value.get("message")  # callback queries
+        if isinstance(message, dict):
+            chat = message.get("chat")
+    user = value.get("from") or value.get("user")
+    if chat is None and user is None:
+        return None
+    return (
+        chat["id"] if chat is not None else None,
+        user["id"] if user is not None else None,
+    )
+
+
+def current_state() -> Union["FSMContext", None]:
+    """
+    State of the chat and user of the update being handled,
+    None without a storage or outside of handlers.
+    """
+    return state_var.get()
+
+
+class FSMContext:
+    """
+    Conversation state of one user in one chat: the name of the
+    current step (or None) and a dict of anything collected so far.
+    Loaded once per update, changes are written through right away.
+    """
+
+    __slots__ = ("storage", "key", "state", "data")
+
+    def __init__(
+        self,
+        storage: "StateStorage",
+        key: Hashable,
+        state: Union[str, None],
+        data: dict,
+    ):
+        self.storage = storage
+        self.key = key
+        self.state = state
+        self.data = data
+
+    async def set_state(self, state: Union[str, None]):
+        self.state = state
+        await self.storage.set(self.key, state, self.data)
+
+    async def update_data(self, **data):
+        self.data.update(data)
+        await self.storage.set(self.key, self.state, self.data)
+
+    async def set_data(self, data: dict):
+        self.data = dict(data)
+        await self.storage.set(self.key, self.state, self.data)
+
+    async def finish(self):
+        self.state = None
+        self.data = {}
+        await self.storage.delete(self.key)
+
+
+class StateStorage:
+    """
+    Keeps FSMContext state and data by (chat id, user id).
+    """
+
+    async def get(self, key: Hashable) -> Tuple[Union[str, None], dict]:
+        raise NotImplementedError
+
+    async def set(self, key: Hashable, state: Union[str, None], data: dict):
+        raise NotImplementedError
+
+    async def delete(self, key: Hashable):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def load(self, value: dict) -> Union[FSMContext, None]:
+        """
+        Context for a raw update value (a message, a callback query...).
+        """
+        key = state_key(value)
+        if key is None:
+            return None
+        state, data = await self.get(key)
+        return FSMContext(self, key, state, data)
+
+
+class MemoryStorage(StateStorage):
+    """
+    Keeps at most `size` contexts, the least recently used ones are
+    forgotten first, and with `ttl` those not changed for that many
+    seconds are forgotten as well.
+    """
+
+    def __init__(self, size: int = 10000, ttl: Union[float, None] = None):
+        self.size = size
+        self.ttl = ttl
+        # key -> (state, data, expires)
+        self.records: OrderedDict = OrderedDict()
+
+    def _get(self, key: Hashable):
+        record = self.records.get(key)
+        if record is None:
+            return None
+        if record[2] is not None and record[2] < time.monotonic():
+            del self.records[key]
+            return None
+        self.records.move_to_end(key)
+        return record
+
+    def _set(self, key: Hashable, state: Union[str, None], data: dict):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.records[key] = (state, data, expires)
+        self.records.move_to_end(key)
+        if len(self.records) > self.size:
+            self.records.popitem(last=False)
+
+    async def get(self, key: Hashable) -> Tuple[Union[str, None], dict]:
+        record = self._get(key)
+        if record is None:
+            return None, {}
+        return record[0], dict(record[1])
+
+    async def set(self, key: Hashable, state: Union[str, None], data: dict):
+        if state is None and not data:
+            self.records.pop(key, None)
+        else:
+            self._set(key, state, dict(data))
+
+    async def delete(self, key: Hashable):
+        self.records.pop(key, None)
+
+
+class SQLiteStorage(MemoryStorage):
+    """
+    Contexts survive restarts in an SQLite database. Reads go
+    through an LRU cache of `size` contexts (misses included, so
+    users without a state cost nothing after the first update),
+    writes are collected and saved in one transaction every
+    `flush_interval` seconds and on close().
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int = 10000,
+        ttl: Union[float, None] = None,
+        flush_interval: float = 1.0,
+    ):
+        super().__init__(size, ttl)
+        self.path = path
+        self.flush_interval = flush_interval
+        # key -> (state, data) or None to delete, not saved yet
+        self.dirty: Dict[Hashable, Any] = {}
+        self._flusher: Union[asyncio.Task, None] = None
+        self._lock = asyncio.Lock()
+        with sqlite3.connect(self.path) as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, "
+                "state TEXT, data TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def _key(key: Hashable) -> str:
+        return json_codec.dumps(key)
+
+    def _read(self, key: Hashable):
+        with sqlite3.connect(self.path) as db:
+            row = db.execute(
+                "SELECT state, data, updated FROM states WHERE key = ?",
+                (self._key(key),),
+            ).fetchone()
+        if row is None or (self.ttl and row[2] < time.time() - self.ttl):
+            return None, {}
+        return row[0], json_codec.loads(row[1])
+
+    def _write(self, changes: Dict[Hashable, Any]):
+        now = time.time()
+        with sqlite3.connect(self.path) as db:
+            db.executemany(
+                "DELETE FROM states WHERE key = ?",
+                [(self._key(k),) for k, v in changes.items() if v is None],
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?)",
+                [
+                    (self._key(k), v[0], json_codec.dumps(v[1]), now)
+                    for k, v in changes.items()
+                    if v is not None
+                ],
+            )
+
+    async def get(self, key: Hashable) -> Tuple[Union[str, None], dict]:
+        record = self._get(key)
+        if record is None:
+            if key in self.dirty:
+                change = self.dirty[key]
+                state, data = change if change is not None else (None, {})
+            else:
+                state, data = await asyncio.get_running_loop().run_in_executor(
+                    None, self._read, key
+                )
+            self._set(key, state, data)
+            return state, dict(data)
+        return record[0], dict(record[1])
+
+    async def set(self, key: Hashable, state: Union[str, None], data: dict):
+        if state is None and not data:
+            await self.delete(key)
+            return
+        data = dict(data)
+        self._set(key, state, data)
+        self.dirty[key] = (state, data)
+        self._schedule()
+
+    async def delete(self, key: Hashable):
+        # remembered as empty, so that it isn't read again
+        self._set(key, None, {})
+        self.dirty[key] = None
+        self._schedule()
+
+    def _schedule(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flusher = None
+        try:
+            await self.flush()
+        except Exception:
+            logging.exception("Saving states failed")
+            self._schedule()
+
+    async def flush(self):
+        # one write at a time, so that they land in order
+        async with self._lock:
+            if not self.dirty:
+                return
+            changes, self.dirty = self.dirty, {}
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._write, changes
+                )
+            except Exception:
+                # keep them for the next time, newer changes win
+                self.dirty = {**changes, **self.dirty}
+                raise
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        self._flusher = None
+        await self.flush()
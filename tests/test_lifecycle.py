@@ -0,0 +1,76 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from ..benchmarks.fake_server import FakeBotAPI
+from ..bot import Bot
+from ..lifecycle import CANCEL_TIMEOUT, cancel_tasks
+from ..offset_store import FileOffsetStore
+
+
+class CancelTasksTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancels(self):
+        task = asyncio.create_task(asyncio.sleep(60))
+        self.assertTrue(await cancel_tasks([task], timeout=1))
+        self.assertTrue(task.cancelled())
+
+    async def test_gives_up_on_swallowed_cancellation(self):
+        release = asyncio.Event()
+
+        async def stubborn():
+            while not release.is_set():
+                try:
+                    await release.wait()
+                except asyncio.CancelledError:
+                    pass
+
+        task = asyncio.create_task(stubborn())
+        await asyncio.sleep(0)
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(await cancel_tasks([task], timeout=0.1))
+        release.set()
+        await task
+
+
+class DurableStopTest(unittest.IsolatedAsyncioTestCase):
+    updates = 100
+
+    async def asyncSetUp(self):
+        self.server = FakeBotAPI(updates=self.updates, chats=10)
+        await self.server.start()
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, "offset")
+        self.addCleanup(os.rmdir, directory)
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def test_stop_right_after_handling(self):
+        bot = Bot(
+            "0:token",
+            4,
+            api_url=self.server.url,
+            poll_timeout=1,
+            rate_limiter=False,
+            offset_store=FileOffsetStore(self.path),
+            handler_timeout=5,
+        )
+        handled = set()
+        everything = asyncio.Event()
+
+        @bot.register("onMessage")
+        async def handler(message):
+            handled.add(message.message_id)
+            if len(handled) == self.updates:
+                everything.set()
+
+        await bot.start()
+        await asyncio.wait_for(everything.wait(), 10)
+        # well within CANCEL_TIMEOUT, a task that ignored its
+        # cancellation would only be given up on after it
+        stopped = await asyncio.wait_for(bot.stop(5), CANCEL_TIMEOUT / 2)
+        self.assertTrue(stopped)
+        self.assertEqual(FileOffsetStore(self.path).load(), self.updates + 1)
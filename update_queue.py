@@ -0,0 +1,134 @@
+import asyncio
+import time
+from collections import Counter, deque
+from typing import Any, Callable, Iterable, Union
+
+from .metrics import Metrics
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_types")
+
+
+def _edit_key(update: dict):
+    for update_type in ("edited_message", "edited_channel_post"):
+        message = update.get(update_type)
+        if message is not None:
+            return update_type, message["chat"]["id"], message["message_id"]
+    return None
+
+
+def _update_type(update: dict) -> Union[str, None]:
+    for key in update:
+        if key != "update_id":
+            return key
+    return None
+
+
+class UpdateQueue(asyncio.Queue):
+    """
+    Queue of raw updates between the Poller (or webhook) and workers.
+
+    When it is bounded (maxsize > 0), `overflow` decides what
+    happens to an update that doesn't fit:
+    "block" - wait for a free slot, so the poller stops fetching,
+    "drop_oldest" - discard the oldest queued update,
+    "drop_types" - discard the new update if its type is in
+    `shed_types`, otherwise wait like "block".
+
+    With `coalesce_edits`, an edit of a message whose previous edit
+    is still queued replaces that edit instead of taking a new slot.
+
+    Discarded updates are counted by type in `dropped`.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        overflow: str = "block",
+        shed_types: Iterable[str] = (),
+        coalesce_edits: bool = False,
+        metrics: Union[Metrics, None] = None,
+        on_drop: Union[Callable[[int], Any], None] = None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                "overflow must be one of %s" % (OVERFLOW_POLICIES,)
+            )
+        super().__init__(maxsize)
+        self.overflow = overflow
+        self.shed_types = frozenset(shed_types)
+        self.coalesce_edits = coalesce_edits
+        self.dropped = Counter()
+        self.coalesced = 0
+        self._edits = {}
+        self.metrics = metrics
+        self.on_drop = on_drop  # gets the update_id of a dropped update
+        # enqueue times, kept in step with the items for wait times
+        self._times = deque() if metrics is not None else None
+
+    def _put(self, item):
+        super()._put(item)
+        if self._times is not None:
+            self._times.append(time.perf_counter())
+        if self.coalesce_edits:
+            key = _edit_key(item)
+            if key is not None:
+                self._edits[key] = item
+
+    def _get(self):
+        item = super()._get()
+        if self._times is not None:
+            self.metrics.observe(
+                "queue_wait_seconds",
+                time.perf_counter() - self._times.popleft(),
+            )
+        if self._edits:
+            key = _edit_key(item)
+            if key is not None and self._edits.get(key) is item:
+                del self._edits[key]
+        return item
+
+    def _absorb(self, item: dict) -> bool:
+        """
+        Applies coalescing and shedding,
+        returns True if the item is taken care of.
+        """
+        if self._edits:
+            queued = self._edits.get(_edit_key(item))
+            if queued is not None:
+                # updated in place, keeps its position in the queue
+                if self.on_drop is not None:
+                    self.on_drop(queued["update_id"])
+                queued.clear()
+                queued.update(item)
+                self.coalesced += 1
+                if self.metrics is not None:
+                    self.metrics.inc("updates_coalesced")
+                return True
+        if not self.full() or self.overflow == "block":
+            return False
+        if self.overflow == "drop_oldest":
+            old = self.get_nowait()
+            self.task_done()
+            self._drop(old)
+            return False
+        update_type = _update_type(item)
+        if update_type in self.shed_types:
+            self._drop(item)
+            return True
+        return False
+
+    def _drop(self, update: dict):
+        update_type = _update_type(update)
+        self.dropped[update_type] += 1
+        if self.on_drop is not None:
+            self.on_drop(update["update_id"])
+        if self.metrics is not None:
+            self.metrics.inc("updates_dropped", type=update_type)
+
+    def put_nowait(self, item: dict):
+        if not self._absorb(item):
+            super().put_nowait(item)
+
+    async def put(self, item: dict):
+        if not self._absorb(item):
+            await super().put(item)
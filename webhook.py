@@ -0,0 +1,145 @@
+import asyncio
+import hmac
+import logging
+import ssl
+from typing import Callable, List, Union
+
+from aiohttp import web
+
+from . import json_codec
+from .offset_store import UpdateTracker
+
+
+def base_url(api_url: str) -> str:
+    """
+    "api.telegram.org" -> "https://api.telegram.org", an url
+    with a scheme (a local server, say) is kept as it is.
+    """
+    if "://" in api_url:
+        return api_url.rstrip("/")
+    return "https://" + api_url
+
+
+class WebhookServer:
+    """
+    Receives updates pushed by Telegram and puts
+    them into the same queue the Poller would.
+    """
+
+    def __init__(
+        self,
+        token,
+        queue: asyncio.Queue,
+        session,
+        url: str,
+        host: str = "0.0.0.0",
+        port: int = 8443,
+        path: str = "/",
+        secret_token: Union[str, None] = None,
+        api_url: str = "api.telegram.org",
+        skip_updates: bool = False,
+        allowed_updates: Union[
+            Callable[[], List[str]], List[str], None
+        ] = None,
+        max_connections: Union[int, None] = None,
+        ip_address: Union[str, None] = None,
+        ssl_context: Union[ssl.SSLContext, None] = None,
+        delete_on_stop: bool = True,
+        tracker: Union[UpdateTracker, None] = None,
+    ):
+        self.queue = queue
+        self.token = token
+        self.session = session
+        self.url = url
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.api_url = base_url(api_url) + "/bot"
+        self.skip_updates = skip_updates
+        self.allowed_updates = allowed_updates
+        self.max_connections = max_connections
+        self.ip_address = ip_address
+        self.ssl_context = ssl_context
+        self.delete_on_stop = delete_on_stop
+        self.tracker = tracker
+        self.runner: Union[web.AppRunner, None] = None
+        self.logger = logging.getLogger()
+
+    async def make_request(self, method, data):
+        async with self.session.post(
+            self.api_url + self.token + "/" + method, data=data
+        ) as post:
+            a = json_codec.loads(await post.read())
+            logging.debug(a)
+            return a
+
+    async def _handle(self, request: web.Request):
+        if self.secret_token is not None and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""),
+            self.secret_token,
+        ):
+            return web.Response(status=401)
+        try:
+            update = json_codec.loads(await request.read())
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict) or "update_id" not in update:
+            return web.Response(status=400)
+        if self.tracker is not None:
+            if self.tracker.seen(update["update_id"]):
+                return web.Response()  # redelivered, already taken care of
+            self.tracker.begin(update["update_id"])
+        # with a full bounded queue the response is delayed,
+        # which makes Telegram slow down as well
+        await self.queue.put(update)
+        return web.Response()
+
+    async def set_webhook(self, drop_pending: Union[bool, None] = None):
+        """
+        Pending updates are dropped with skip_updates,
+        unless `drop_pending` says otherwise.
+        """
+        params = {"url": self.url}
+        if self.secret_token is not None:
+            params["secret_token"] = self.secret_token
+        allowed_updates = self.allowed_updates
+        if callable(allowed_updates):
+            allowed_updates = allowed_updates()
+        if allowed_updates is not None:
+            params["allowed_updates"] = json_codec.dumps(allowed_updates)
+        if self.max_connections is not None:
+            params["max_connections"] = self.max_connections
+        if self.ip_address is not None:
+            params["ip_address"] = self.ip_address
+        if drop_pending is None:
+            drop_pending = self.skip_updates
+        if drop_pending:
+            params["drop_pending_updates"] = "true"
+        res = await self.make_request("setWebhook", params)
+        if not res.get("ok"):
+            raise RuntimeError("setWebhook failed: %s" % res)
+        return res
+
+    async def delete_webhook(self):
+        return await self.make_request("deleteWebhook", {})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(
+            self.runner, self.host, self.port, ssl_context=self.ssl_context
+        )
+        await site.start()
+        await self.set_webhook()
+
+    async def stop(self):
+        try:
+            if self.delete_on_stop:
+                await self.delete_webhook()
+        finally:
+            if self.runner is not None:
+                await self.runner.cleanup()
+                self.runner = None